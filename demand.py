@@ -0,0 +1,123 @@
+'''
+Demand injection through TraCI instead of a pre-written route file.
+
+The route file only holds the vehicle type and the four routes, vehicles are
+added with traci.vehicle.add a little ahead of their departure. Arrivals are
+Bernoulli per second with a rate per route taken from a piecewise constant,
+optionally periodic, profile. The default profile and seed draw the same
+vehicles as SumoIntersection.generate_routefile, so a run with injection
+matches one with the written route file, but SUMO starts in constant time
+and the horizon may be unbounded.
+
+A profile file is JSON with rates in vehicles per second from the given time on:
+
+    {"period": 86400,
+     "routes": {"horizontal": [[0, 0.05], [25200, 0.2], [68400, 0.05]],
+                "vertical": [[0, 0.09]],
+                "always_left": [[0, 0.04]],
+                "always_right": [[0, 0.033]]}}
+'''
+
+import bisect
+import json
+import random
+
+import traci
+
+ROUTE_DEFINITIONS = '''<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">
+    <vType id="SUMO_DEFAULT_TYPE" accel="0.8" decel="4.5" sigma="0" length="5" minGap="2" maxSpeed="70"/>
+    <route id="always_right" edges="1fi 1si 4o 4fi 4si 2o 2fi 2si 3o 3fi 3si 1o 1fi"/>
+    <route id="always_left" edges="3fi 3si 2o 2fi 2si 4o 4fi 4si 1o 1fi 1si 3o 3fi"/>
+    <route id="horizontal" edges="2fi 2si 1o 1fi 1si 2o 2fi"/>
+    <route id="vertical" edges="3fi 3si 4o 4fi 4si 3o 3fi"/>
+</routes>
+'''
+
+# Routes in the order generate_routefile draws them, with id prefix and color
+ROUTES = (('horizontal', 'right', None),
+          ('vertical', 'left', None),
+          ('always_left', 'down', '1,0,0'),
+          ('always_right', 'down', '1,0,0'))
+
+# generate_routefile's demand
+DEFAULT_PROFILE = {'routes': {'horizontal': [[0, 1. / 7]],
+                              'vertical': [[0, 1. / 11]],
+                              'always_left': [[0, 1. / 25]],
+                              'always_right': [[0, 1. / 30]]}}
+
+
+def write_route_definitions(path="input_routes_defs.rou.xml"):
+    with open(path, "w") as routes:
+        routes.write(ROUTE_DEFINITIONS)
+    return path
+
+
+def load_profile(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class DemandInjector:
+    def __init__(self, profile=None, seed=42, horizon=3600, lookahead=60):
+        profile = profile or DEFAULT_PROFILE
+        self.period = profile.get('period')
+        self.rates = []
+        for route, prefix, color in ROUTES:
+            breakpoints = sorted(profile['routes'].get(route, [[0, 0.]]))
+            self.rates.append(([t for t, rate in breakpoints], [rate for t, rate in breakpoints]))
+        self.seed = seed
+        self.horizon = horizon      # seconds with departures, None for unbounded
+        self.lookahead = lookahead  # seconds vehicles are added ahead of departure
+        self.reset()
+
+    def reset(self):
+        # Start a new episode with the same draws
+        self.random = random.Random(self.seed)
+        self.next_second = 0
+        self.vehicles = 0
+        self.present = set()
+
+    def rate(self, route_index, t):
+        times, rates = self.rates[route_index]
+        if self.period:
+            t = t % self.period
+        return rates[max(bisect.bisect_right(times, t) - 1, 0)]
+
+    def inject(self, now):
+        # Add the vehicles departing before now + lookahead, returns how many
+        until = now + self.lookahead
+        if self.horizon is not None:
+            until = min(until, self.horizon)
+        added = 0
+        while self.next_second < until:
+            t = self.next_second
+            for i, (route, prefix, color) in enumerate(ROUTES):
+                if self.random.uniform(0, 1) < self.rate(i, t):
+                    vehID = '%s_%i' % (prefix, self.vehicles)
+                    self.vehicles += 1
+                    if vehID in self.present:
+                        # restored from a saved state (snapshots.py)
+                        continue
+                    traci.vehicle.add(vehID, route, typeID="SUMO_DEFAULT_TYPE", depart=str(t))
+                    if color is not None:
+                        traci.vehicle.setColor(vehID, tuple(int(c) * 255 for c in color.split(',')) + (255,))
+                    added += 1
+            self.next_second += 1
+        return added
+
+    def mark_present(self):
+        # After loading a saved state: its vehicles, driving or waiting for
+        # insertion, are not added again
+        self.present = set(traci.vehicle.getIDList()) | set(traci.simulation.getPendingVehicles())
+
+    def skip_to(self, t):
+        # Draw, but do not add, the departures before t, for episodes that
+        # start from a saved state at time t
+        while self.next_second < t:
+            for i in range(len(ROUTES)):
+                if self.random.uniform(0, 1) < self.rate(i, self.next_second):
+                    self.vehicles += 1
+            self.next_second += 1
+
+    def finished(self):
+        return self.horizon is not None and self.next_second >= self.horizon
@@ -0,0 +1,250 @@
+'''
+Distillation of the DQN policy into a small decision tree.
+
+The teacher (DQNAgent with trained weights) drives headless SUMO episodes with
+some exploration, and every observation is reduced to nine features:
+
+    queue_1si .. queue_4si   occupied cells of the approach in the position grid
+    speed_1si .. speed_4si   mean normalized speed of those cells
+    light                    1 while phase 4 (the state's light[0]) is green
+
+A depth-limited CART tree is fitted on the teacher's greedy actions and stored
+as JSON. TreePolicy evaluates it with a handful of comparisons in plain
+Python, and has the act(state) interface of policy_server.PolicyClient, so
+traffic_light_control.py --distilled PATH runs it in place of the network.
+
+    python distill.py --weights Models/reinf_traf_control.h5 --episodes 5 --depth 6 --out Models/distilled_tree.json
+reports the agreement with the teacher on held-out observations, the decision
+latency of both, and the waiting time of one greedy SUMO episode with each.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import optparse
+import random
+import time
+
+import numpy as np
+
+# Grid rows of each incoming edge, as in getState
+APPROACH_ROWS = ((0, 3), (3, 6), (6, 9), (9, 12))
+FEATURES = ('queue_1si', 'queue_2si', 'queue_3si', 'queue_4si',
+            'speed_1si', 'speed_2si', 'speed_3si', 'speed_4si', 'light')
+
+
+def features(position, velocity, light):
+    # Batched (n,12,12,1), (n,12,12,1), (n,2,1) -> (n, 9)
+    position = np.asarray(position, dtype=np.float64)[..., 0]
+    velocity = np.asarray(velocity, dtype=np.float64)[..., 0]
+    columns = []
+    counts = [position[:, lo:hi].sum(axis=(1, 2)) for lo, hi in APPROACH_ROWS]
+    columns.extend(counts)
+    for (lo, hi), count in zip(APPROACH_ROWS, counts):
+        columns.append(velocity[:, lo:hi].sum(axis=(1, 2)) / np.maximum(count, 1))
+    columns.append(np.asarray(light, dtype=np.float64)[:, 0, 0])
+    return np.stack(columns, axis=1)
+
+
+def _gini(counts):
+    p = counts / np.maximum(counts.sum(axis=-1, keepdims=True), 1)
+    return 1. - (p * p).sum(axis=-1)
+
+
+class DecisionTree:
+    # Nodes in flat lists, leaves have feature -1 and their action in value
+    def __init__(self, feature=None, threshold=None, left=None, right=None, value=None):
+        self.feature = feature or []
+        self.threshold = threshold or []
+        self.left = left or []
+        self.right = right or []
+        self.value = value or []
+
+    def fit(self, X, y, max_depth=6, min_leaf=20, n_actions=2):
+        self.feature, self.threshold, self.left, self.right, self.value = [], [], [], [], []
+        self._grow(np.asarray(X, dtype=np.float64), np.asarray(y, dtype=np.intp), 0, max_depth, min_leaf, n_actions)
+        return self
+
+    def _node(self, feature, threshold, value):
+        self.feature.append(feature)
+        self.threshold.append(threshold)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.value.append(value)
+        return len(self.feature) - 1
+
+    def _grow(self, X, y, depth, max_depth, min_leaf, n_actions):
+        counts = np.bincount(y, minlength=n_actions)
+        majority = int(np.argmax(counts))
+        if depth == max_depth or len(y) < 2 * min_leaf or counts.max() == len(y):
+            return self._node(-1, 0., majority)
+
+        best = None
+        parent = _gini(counts) * len(y)
+        for f in range(X.shape[1]):
+            order = np.argsort(X[:, f], kind='stable')
+            xs = X[order, f]
+            # Class counts left of every split position
+            left = np.cumsum(np.eye(n_actions, dtype=np.int64)[y[order]], axis=0)[:-1]
+            right = counts - left
+            n_left = np.arange(1, len(y))
+            valid = (xs[1:] != xs[:-1]) & (n_left >= min_leaf) & (len(y) - n_left >= min_leaf)
+            if not valid.any():
+                continue
+            impurity = _gini(left) * n_left + _gini(right) * (len(y) - n_left)
+            impurity[~valid] = np.inf
+            i = int(np.argmin(impurity))
+            if best is None or impurity[i] < best[0]:
+                best = (impurity[i], f, (xs[i] + xs[i + 1]) / 2.)
+        if best is None or best[0] >= parent:
+            return self._node(-1, 0., majority)
+
+        _, f, threshold = best
+        node = self._node(f, float(threshold), majority)
+        mask = X[:, f] <= threshold
+        self.left[node] = self._grow(X[mask], y[mask], depth + 1, max_depth, min_leaf, n_actions)
+        self.right[node] = self._grow(X[~mask], y[~mask], depth + 1, max_depth, min_leaf, n_actions)
+        return node
+
+    def decide(self, x):
+        node = 0
+        while self.feature[node] >= 0:
+            node = self.left[node] if x[self.feature[node]] <= self.threshold[node] else self.right[node]
+        return self.value[node]
+
+    def predict(self, X):
+        return np.array([self.decide(x) for x in X], dtype=np.intp)
+
+    def depth(self, node=0):
+        if self.feature[node] < 0:
+            return 0
+        return 1 + max(self.depth(self.left[node]), self.depth(self.right[node]))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'features': FEATURES, 'feature': self.feature, 'threshold': self.threshold,
+                       'left': self.left, 'right': self.right, 'value': self.value}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            tree = json.load(f)
+        if tuple(tree['features']) != FEATURES:
+            raise ValueError('%s was fitted on features %s' % (path, tree['features']))
+        return cls(tree['feature'], tree['threshold'], tree['left'], tree['right'], tree['value'])
+
+
+class TreePolicy:
+    # Same act interface as policy_server.PolicyClient, without Q-values
+    def __init__(self, path):
+        self.tree = DecisionTree.load(path)
+
+    def act(self, state):
+        return self.tree.decide(features(*state)[0]), None
+
+
+def collect(agent, sumoBinary, episodes, epsilon=0.1, max_steps=7000, tg=10, ty=6):
+    # Observations of teacher-driven episodes and the teacher's greedy actions
+    import traci
+    from traffic_light_control import SumoIntersection, action_segments
+
+    sumoInt = SumoIntersection()
+    observations = []
+    for e in range(episodes):
+        sumoInt.generate_routefile(seed=42 + e)
+        traci.start([sumoBinary, "-c", "cross3ltl.sumocfg", '--start'])
+        traci.trafficlight.setPhase("0", 0)
+        traci.trafficlight.setPhaseDuration("0", 200)
+        stepz = 0
+        while traci.simulation.getMinExpectedNumber() > 0 and stepz < max_steps:
+            traci.simulationStep()
+            state = sumoInt.getState()
+            observations.append(state)
+            q_values = agent.model.predict_on_batch(state)
+            action = int(np.argmax(q_values[0]))
+            if random.random() < epsilon:
+                action = random.randrange(agent.action_size)
+            current = 0 if state[2][0][0][0] == 1 else 1
+            for phase, duration, reward_edges in action_segments(action, current, tg, ty):
+                stepz += sumoInt.run_phase(phase, duration)[0]
+        traci.close()
+        print('collected episode %d - %d observations' % (e, len(observations)))
+    position, velocity, light = [np.concatenate(s) for s in zip(*observations)]
+    actions = np.argmax(agent.model.predict(
+        [position, velocity, light], batch_size=256, verbose=0), axis=1)
+    return features(position, velocity, light), actions, [position, velocity, light]
+
+
+def waiting_time(choose, sumoBinary, max_steps=7000, tg=10, ty=6):
+    # Total waiting time of one greedy episode on the default route file
+    import traci
+    from traffic_light_control import SumoIntersection, action_segments
+
+    sumoInt = SumoIntersection()
+    sumoInt.generate_routefile()
+    traci.start([sumoBinary, "-c", "cross3ltl.sumocfg", '--start'])
+    traci.trafficlight.setPhase("0", 0)
+    traci.trafficlight.setPhaseDuration("0", 200)
+    stepz = 0
+    total = 0
+    while traci.simulation.getMinExpectedNumber() > 0 and stepz < max_steps:
+        traci.simulationStep()
+        state = sumoInt.getState()
+        current = 0 if state[2][0][0][0] == 1 else 1
+        for phase, duration, reward_edges in action_segments(choose(state), current, tg, ty):
+            steps, waiting, _, _ = sumoInt.run_phase(phase, duration)
+            stepz += steps
+            total += waiting
+    traci.close()
+    return total
+
+
+def _latency_us(fn, states):
+    start = time.perf_counter()
+    for state in states:
+        fn(state)
+    return (time.perf_counter() - start) / len(states) * 1e6
+
+
+if __name__ == '__main__':
+    from sumolib import checkBinary
+    from traffic_light_control import DQNAgent
+
+    optParser = optparse.OptionParser()
+    optParser.add_option("--weights", default="Models/reinf_traf_control.h5")
+    optParser.add_option("--episodes", type="int", default=5, help="teacher episodes to collect")
+    optParser.add_option("--epsilon", type="float", default=0.1,
+                         help="exploration while collecting, widens the visited states")
+    optParser.add_option("--depth", type="int", default=6)
+    optParser.add_option("--min-leaf", type="int", default=20)
+    optParser.add_option("--holdout", type="float", default=0.2, help="fraction kept for the agreement")
+    optParser.add_option("--out", default="Models/distilled_tree.json")
+    optParser.add_option("--no-eval", action="store_true", default=False,
+                         help="skip the SUMO waiting time comparison")
+    options, args = optParser.parse_args()
+
+    sumoBinary = checkBinary('sumo')
+    agent = DQNAgent()
+    agent.load(options.weights)
+    X, y, states = collect(agent, sumoBinary, options.episodes, options.epsilon)
+
+    order = np.random.RandomState(0).permutation(len(y))
+    split = int(len(y) * (1. - options.holdout))
+    train_idx, test_idx = order[:split], order[split:]
+    tree = DecisionTree().fit(X[train_idx], y[train_idx], options.depth, options.min_leaf)
+    tree.save(options.out)
+    agreement = np.mean(tree.predict(X[test_idx]) == y[test_idx])
+    print('tree      - %d nodes, depth %d, saved to %s' % (len(tree.feature), tree.depth(), options.out))
+    print('agreement - %.2f%% of %d held-out observations (teacher picks action 1 in %.1f%%)' % (
+        agreement * 100., len(test_idx), y[test_idx].mean() * 100.))
+
+    policy = TreePolicy(options.out)
+    samples = [[s[i:i + 1] for s in states] for i in test_idx[:500]]
+    print('latency   - teacher predict_on_batch %.1f us, tree incl. features %.1f us' % (
+        _latency_us(agent.model.predict_on_batch, samples), _latency_us(policy.act, samples)))
+
+    if not options.no_eval:
+        teacher = waiting_time(lambda s: int(np.argmax(agent.model.predict_on_batch(s)[0])), sumoBinary)
+        student = waiting_time(lambda s: policy.act(s)[0], sumoBinary)
+        print('waiting   - teacher %d, tree %d (%+.1f%%)' % (teacher, student, (student - teacher) * 100. / teacher))
@@ -0,0 +1,152 @@
+'''
+The DQN agent of traffic_light_control.py: replay memory, act and replay
+around a Keras network that is built on first use.
+
+Kept apart from the SUMO loop so tools that only train or act on recorded
+data, offline_train.py, import neither traci nor sumolib.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import random
+from collections import deque
+
+import numpy as np
+
+import model_artifact
+from state_codec import encode_state, decode_state
+
+
+class DQNAgent:
+    def __init__(self, compact_memory=False, gamma=0.95, epsilon=0.1,
+                 learning_rate=0.0002, memory_size=200, action_size=2):
+        self.gamma = gamma   # discount rate
+        self.epsilon = epsilon  # exploration rate
+        self.learning_rate = learning_rate
+        self.memory = deque(maxlen=memory_size)
+        self.compact_memory = compact_memory  # store states encoded by state_codec
+        self.copy_states = False  # states are views into reused buffers (observation.py)
+        # Backend answering act() instead of self.model, a policy_server.PolicyClient
+        # or a tflite_export.TFLiteBackend
+        self.policy_client = None
+        # q_cache.QValueCache in front of self.model in act(), None for off
+        self.q_cache = None
+        self.action_size = action_size  # 2, or phases times green durations (green_action_size)
+        self._model = None  # built on first use of self.model
+
+    @property
+    def model(self):
+        # Keras is imported and the network built and compiled only when
+        # needed, an agent acting through a policy_client never pays for it
+        if self._model is None:
+            self._model = self._build_model()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def _build_model(self):
+        import keras
+        from keras.layers import Input, Conv2D, Flatten, Dense
+        from keras.models import Model
+
+        # Neural Net for Deep-Q learning Model, the input names are used by
+        # tflite_export.TFLiteBackend to find the inputs of a converted model
+        input_1 = Input(shape=(12, 12, 1), name='position')
+        x1 = Conv2D(16, (4, 4), strides=(2, 2), activation='relu')(input_1)
+        x1 = Conv2D(32, (2, 2), strides=(1, 1), activation='relu')(x1)
+        x1 = Flatten()(x1)
+
+        input_2 = Input(shape=(12, 12, 1), name='velocity')
+        x2 = Conv2D(16, (4, 4), strides=(2, 2), activation='relu')(input_2)
+        x2 = Conv2D(32, (2, 2), strides=(1, 1), activation='relu')(x2)
+        x2 = Flatten()(x2)
+
+        input_3 = Input(shape=(2, 1), name='light')
+        x3 = Flatten()(input_3)
+
+        x = keras.layers.concatenate([x1, x2, x3])
+        x = Dense(128, activation='relu')(x)
+        x = Dense(64, activation='relu')(x)
+        x = Dense(self.action_size, activation='linear')(x)
+
+        model = Model(inputs=[input_1, input_2, input_3], outputs=[x])
+        model.compile(optimizer=keras.optimizers.RMSprop(
+            lr=self.learning_rate), loss='mse')
+
+        return model
+
+    def remember(self, state, action, reward, next_state, done, steps=1.):
+        # steps: decisions the transition counts as when discounting, its
+        # simulated seconds over tg when the green durations vary
+        if self.compact_memory:
+            state = encode_state(state)
+            next_state = encode_state(next_state)
+        elif self.copy_states:
+            state = [np.array(s) for s in state]
+            next_state = [np.array(s) for s in next_state]
+        self.memory.append((state, action, reward, next_state, done, steps))
+
+    def act(self, state):
+        if np.random.rand() <= self.epsilon:
+            return random.randrange(self.action_size)
+        if self.policy_client is not None:
+            return self.policy_client.act(state)[0]
+        if self.q_cache is not None:
+            act_values = self.q_cache.q_values(state, self.model.predict)
+        else:
+            act_values = self.model.predict(state)
+
+        return np.argmax(act_values[0])  # returns action
+
+    def act_batch(self, states):
+        # One action per row of batched [position, velocity, lgts], with a
+        # single forward pass for all rows that do not explore
+        n = len(states[0])
+        explore = np.random.rand(n) <= self.epsilon
+        actions = np.random.randint(self.action_size, size=n)
+        if not explore.all():
+            act_values = self.model.predict_on_batch(states)
+            actions = np.where(explore, actions, np.argmax(act_values, axis=1))
+        return actions
+
+    def replay(self, batch_size):
+        minibatch = random.sample(self.memory, batch_size)
+        for state, action, reward, next_state, done, steps in minibatch:
+            if self.compact_memory:
+                state = decode_state(state)
+                next_state = decode_state(next_state)
+            target = reward
+            if not done:
+                target = (reward + self.gamma ** steps *
+                          np.amax(self.model.predict(next_state)[0]))
+            target_f = self.model.predict(state)
+            target_f[0][action] = target
+            self.model.fit(state, target_f, epochs=1, verbose=0)
+        if self.q_cache is not None:
+            self.q_cache.invalidate()
+
+    def load(self, name):
+        self.model.load_weights(name)
+        if self.q_cache is not None:
+            self.q_cache.invalidate()
+
+    def save(self, name):
+        self.model.save_weights(name)
+
+    def load_artifact(self, name):
+        # Weights of a model_artifact.py file, validated, raises ValueError
+        artifact = model_artifact.Artifact(name, self.action_size)
+        weights = artifact.keras_weights()
+        shapes = [w.shape for w in self.model.get_weights()]
+        if [w.shape for w in weights] != shapes:
+            raise ValueError('%s: weight shapes %s, the model has %s' % (name, [w.shape for w in weights], shapes))
+        self.model.set_weights(weights)
+        if self.q_cache is not None:
+            self.q_cache.invalidate()
+        return artifact
+
+    def save_artifact(self, name, **metadata):
+        model_artifact.save(self.model, name, gamma=self.gamma, learning_rate=self.learning_rate, **metadata)
@@ -0,0 +1,74 @@
+'''
+Early termination rules for training episodes.
+
+With time-to-teleport disabled a policy that deadlocks the junction keeps
+SUMO running until the step limit. EarlyTermination watches cheap per-second
+metrics and tells the main loop when an episode is no longer worth simulating.
+'''
+
+# Total waiting time of the static light program on input_routes.rou.xml
+STATIC_WAITING_TIME = 338798
+STATIC_ROUTE_SEED = 42  # generate_routefile seed of that route file
+
+
+class EarlyTermination:
+    def __init__(self, max_queue=None, queue_patience=120, stall_seconds=None,
+                 baseline_waiting_time=None, max_steps=7000):
+        self.max_queue = max_queue                  # halting vehicles considered a jam
+        self.queue_patience = queue_patience        # seconds the jam may last
+        self.stall_seconds = stall_seconds          # seconds without any arrival
+        self.baseline_waiting_time = baseline_waiting_time
+        self.max_steps = max_steps
+        self.seconds_saved = 0
+        self.terminated_episodes = 0
+        self.reset()
+
+    def enabled(self):
+        return (self.max_queue is not None or self.stall_seconds is not None or
+                self.baseline_waiting_time is not None)
+
+    def reset(self):
+        self.steps = 0
+        self.waiting_time = 0
+        self.queue_seconds = 0
+        self.stalled_seconds = 0
+        self.reason = None
+
+    def update(self, queue, arrived):
+        # Feed the halting vehicles and the arrivals of one simulated second.
+        # Returns True once a rule fires; the reason is kept in self.reason.
+        self.steps += 1
+        self.waiting_time += queue
+
+        if self.max_queue is not None:
+            self.queue_seconds = self.queue_seconds + 1 if queue > self.max_queue else 0
+            if self.queue_seconds >= self.queue_patience:
+                self.reason = 'queue above %d for %d s' % (self.max_queue, self.queue_seconds)
+
+        if self.stall_seconds is not None:
+            # An empty network is not a gridlock, only count seconds with a queue
+            self.stalled_seconds = self.stalled_seconds + 1 if queue > 0 and arrived == 0 else 0
+            if self.stalled_seconds >= self.stall_seconds:
+                self.reason = 'no throughput for %d s' % self.stalled_seconds
+
+        if (self.baseline_waiting_time is not None and
+                self.waiting_time > self.baseline_waiting_time):
+            self.reason = 'waiting time %d above baseline %d' % (
+                self.waiting_time, self.baseline_waiting_time)
+
+        return self.reason is not None
+
+    def skip(self, seconds):
+        # Seconds fast-forwarded without vehicles in view, nothing is queued
+        self.steps += seconds
+        self.queue_seconds = 0
+        self.stalled_seconds = 0
+
+    def finish_episode(self):
+        # Account the simulated seconds the step limit would still have cost
+        saved = 0
+        if self.reason is not None:
+            saved = max(self.max_steps - self.steps, 0)
+            self.seconds_saved += saved
+            self.terminated_episodes += 1
+        return saved
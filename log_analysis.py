@@ -0,0 +1,196 @@
+'''
+Streaming analysis of the queue and episode logs.
+
+Understands the free-text logs written by the training scripts
+
+    queue_before_action.txt / queue_after_action.txt   Step N: Queue = Q
+    log.txt                                            episode - E, total waiting time - W, static waiting time - S
+    stdout of traffic_light_control.py                 episode - E total waiting time - W
+
+and JSON lines with the same fields ({"step": N, "queue": Q} or
+{"episode": E, "waiting_time": W, "static_waiting_time": S}). Files are read
+in fixed size chunks and each chunk is parsed with one regex pass into NumPy
+arrays, so memory stays bounded by the chunk size and the per-episode results.
+
+Queue logs restart their step counter every episode, a step smaller than the
+previous one starts a new episode.
+
+    python log_analysis.py --queue queue_before_action.txt --episodes log.txt --window 20 --out summary
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import csv
+import json
+import optparse
+import re
+
+import numpy as np
+
+from early_termination import STATIC_WAITING_TIME
+
+QUEUE_PATTERN = re.compile(rb'Step (\d+): Queue = (\d+)|"step": *(\d+), *"queue": *(\d+)')
+EPISODE_PATTERN = re.compile(
+    rb'episode - (\d+),? total waiting time - (\d+)(?:, static waiting time - (\d+))?|'
+    rb'"episode": *(\d+), *"waiting_time": *(\d+)(?:, *"static_waiting_time": *(\d+))?')
+
+
+def iter_chunks(path, chunk_bytes=64 << 20):
+    # Chunks of whole lines
+    rest = b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield data[:end]
+    if rest:
+        yield rest
+
+
+def _columns(matches, first, second):
+    # bytes -> int64 columns, taking each value from the free-text group or,
+    # when that did not match, from the JSON group. Missing values become -1.
+    if not matches:
+        return [np.zeros(0, dtype=np.int64) for i in range(len(first))]
+    rows = np.array(matches, dtype=np.bytes_)
+    columns = []
+    for primary, alternative in zip(first, second):
+        column = np.where(rows[:, primary] != b'', rows[:, primary], rows[:, alternative])
+        column[column == b''] = b'-1'
+        columns.append(column.astype(np.int64))
+    return columns
+
+
+def parse_queue_log(path, chunk_bytes=64 << 20):
+    # Per episode: number of records, mean and max queue
+    counts, sums, maxima = [], [], []
+    current = None   # [count, sum, max] of the episode spanning chunk boundaries
+    last_step = -1
+    for chunk in iter_chunks(path, chunk_bytes):
+        steps, queues = _columns(QUEUE_PATTERN.findall(chunk), (0, 1), (2, 3))
+        if not len(steps):
+            continue
+        previous = np.concatenate(([last_step], steps[:-1]))
+        starts = np.flatnonzero(steps < previous)
+        last_step = steps[-1]
+        bounds = np.concatenate(([0], starts, [len(steps)]))
+        for i in range(len(bounds) - 1):
+            lo, hi = bounds[i], bounds[i + 1]
+            if hi == lo:
+                continue
+            segment = queues[lo:hi]
+            if i > 0 or current is None:
+                if current is not None:
+                    counts.append(current[0])
+                    sums.append(current[1])
+                    maxima.append(current[2])
+                current = [0, 0, 0]
+            current[0] += len(segment)
+            current[1] += int(segment.sum())
+            current[2] = max(current[2], int(segment.max()))
+    if current is not None:
+        counts.append(current[0])
+        sums.append(current[1])
+        maxima.append(current[2])
+    counts = np.array(counts, dtype=np.int64)
+    return {'records': counts,
+            'mean_queue': np.array(sums, dtype=np.float64) / np.maximum(counts, 1),
+            'max_queue': np.array(maxima, dtype=np.int64)}
+
+
+def parse_episode_log(path, chunk_bytes=64 << 20):
+    episodes, waiting, static = [], [], []
+    for chunk in iter_chunks(path, chunk_bytes):
+        e, w, s = _columns(EPISODE_PATTERN.findall(chunk), (0, 1, 2), (3, 4, 5))
+        episodes.append(e)
+        waiting.append(w)
+        static.append(s)
+    episodes = np.concatenate(episodes) if episodes else np.zeros(0, dtype=np.int64)
+    waiting = np.concatenate(waiting) if waiting else np.zeros(0, dtype=np.int64)
+    static = np.concatenate(static) if static else np.zeros(0, dtype=np.int64)
+    static = np.where(static < 0, STATIC_WAITING_TIME, static)
+    return {'episode': episodes, 'waiting_time': waiting, 'static_waiting_time': static}
+
+
+def rolling_mean(values, window):
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return values
+    cumulative = np.concatenate(([0.], np.cumsum(values)))
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    ends = np.arange(1, len(values) + 1)
+    return (cumulative[ends] - cumulative[ends - counts]) / counts
+
+
+def summarize_episodes(log, window):
+    waiting = log['waiting_time'].astype(np.float64)
+    improvement = 1. - waiting / log['static_waiting_time']
+    summary = {'episodes': int(len(waiting))}
+    if len(waiting):
+        slope = np.polyfit(np.arange(len(waiting)), waiting, 1)[0] if len(waiting) > 1 else 0.
+        summary.update({'mean_waiting_time': float(waiting.mean()),
+                        'best_waiting_time': float(waiting.min()),
+                        'last_rolling_waiting_time': float(rolling_mean(waiting, window)[-1]),
+                        'waiting_time_trend_per_episode': float(slope),
+                        'mean_improvement_vs_static': float(improvement.mean()),
+                        'episodes_better_than_static': int((improvement > 0).sum())})
+    log['rolling_waiting_time'] = rolling_mean(waiting, window)
+    log['improvement_vs_static'] = improvement
+    log['rolling_improvement'] = rolling_mean(improvement, window)
+    return summary
+
+
+def summarize_queue(stats, window):
+    summary = {'episodes': int(len(stats['records']))}
+    if len(stats['records']):
+        summary.update({'records': int(stats['records'].sum()),
+                        'mean_queue': float(np.average(stats['mean_queue'], weights=stats['records'])),
+                        'max_queue': int(stats['max_queue'].max()),
+                        'last_rolling_mean_queue': float(rolling_mean(stats['mean_queue'], window)[-1])})
+    stats['rolling_mean_queue'] = rolling_mean(stats['mean_queue'], window)
+    return summary
+
+
+def write_csv(path, columns):
+    names = sorted(columns)
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['index'] + names)
+        for i in range(len(columns[names[0]]) if names else 0):
+            writer.writerow([i] + [columns[name][i] for name in names])
+
+
+if __name__ == '__main__':
+    optParser = optparse.OptionParser()
+    optParser.add_option("--queue", action="append", default=[],
+                         help="queue log to analyse, may be repeated")
+    optParser.add_option("--episodes", action="append", default=[],
+                         help="episode log (log.txt or training stdout), may be repeated")
+    optParser.add_option("--window", type="int", default=20, help="episodes in rolling statistics")
+    optParser.add_option("--chunk-mb", type="int", default=64)
+    optParser.add_option("--out", default=None,
+                         help="prefix for per-episode CSV files and the JSON summary")
+    options, args = optParser.parse_args()
+
+    report = {}
+    for path in options.queue:
+        stats = parse_queue_log(path, options.chunk_mb << 20)
+        report[path] = summarize_queue(stats, options.window)
+        if options.out:
+            write_csv(options.out + '_' + path.replace('/', '_') + '.csv', stats)
+    for path in options.episodes:
+        log = parse_episode_log(path, options.chunk_mb << 20)
+        report[path] = summarize_episodes(log, options.window)
+        if options.out:
+            write_csv(options.out + '_' + path.replace('/', '_') + '.csv', log)
+
+    print(json.dumps(report, indent=1))
+    if options.out:
+        with open(options.out + '.json', 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,77 @@
+'''
+Per-episode memory reporting for long training runs.
+
+MemoryMonitor samples the resident set size of the process (from
+/proc/self/status, or the peak from getrusage where /proc is missing) and,
+optionally, the Python heap traced by tracemalloc. The first `warmup` episodes
+set the baseline, later episodes print a warning when the RSS has grown more
+than `alert_mb` over the baseline or more than `alert_mb / 4` in one episode.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import resource
+import sys
+import tracemalloc
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    # Peak only, in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. * 1024. if sys.platform == 'darwin' else 1024.)
+
+
+class MemoryMonitor:
+    def __init__(self, alert_mb=200, warmup=3, trace=False):
+        self.alert_mb = alert_mb
+        self.warmup = warmup
+        self.trace = trace
+        self.episodes = 0
+        self.baseline = None
+        self.last = rss_mb()
+        self.alerts = 0
+        if trace:
+            tracemalloc.start()
+
+    def episode(self, e):
+        # Report the episode just finished, returns True on an alert
+        rss = rss_mb()
+        growth = rss - self.last
+        self.last = rss
+        self.episodes += 1
+        line = 'episode - %d rss %.1f MB (%+.1f)' % (e, rss, growth)
+        if self.trace:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            line += ', python heap %.1f MB, peak %.1f MB' % (current / 1048576., peak / 1048576.)
+        print(line)
+
+        if self.episodes == self.warmup:
+            self.baseline = rss
+        alert = False
+        if self.baseline is not None and rss - self.baseline > self.alert_mb:
+            print('WARNING memory grew %.1f MB over the baseline of %.1f MB' % (rss - self.baseline, self.baseline))
+            alert = True
+        elif self.episodes > self.warmup and growth > self.alert_mb / 4.:
+            print('WARNING memory grew %.1f MB in episode %d' % (growth, e))
+            alert = True
+        self.alerts += alert
+        return alert
+
+    def top(self, limit=5):
+        # Largest allocation sites, only with trace=True
+        if not self.trace:
+            return []
+        return tracemalloc.take_snapshot().statistics('lineno')[:limit]
+
+    def close(self):
+        if self.trace:
+            tracemalloc.stop()
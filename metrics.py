@@ -0,0 +1,190 @@
+'''
+Live metrics of training and control runs.
+
+Counters, gauges and histograms are plain Python objects updated from the main
+loop with an attribute add or assignment, no locks and no formatting on the hot
+path. A Registry renders them in the Prometheus text format; serve() answers
+GET /metrics on a localhost port from a daemon thread, and FileDumper writes
+the same text, plus per-second rates of the counters since the previous dump,
+to a file every few seconds.
+
+    python traffic_light_control.py --nogui --metrics-port 9100 --metrics-file metrics.prom
+    curl localhost:9100/metrics
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import bisect
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=(.0005, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1.)):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for edge, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{le="%g"}' % (self.name, edge), cumulative
+        yield '%s_bucket{le="+Inf"}' % self.name, self.count
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+
+class Registry:
+    def __init__(self, prefix='tlc_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(self.prefix + name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(self.prefix + name, help))
+
+    def histogram(self, name, help, **kwargs):
+        return self._add(Histogram(self.prefix + name, help, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def serve(registry, port, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class FileDumper:
+    def __init__(self, registry, path, interval=10.):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.previous = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _rates(self):
+        now = time.time()
+        values = dict((m.name, m.value) for m in self.registry.metrics if m.kind == 'counter')
+        lines = []
+        if self.previous is not None:
+            then, old = self.previous
+            for name, value in sorted(values.items()):
+                lines.append('# rate %s_per_second %.3f' % (name, (value - old[name]) / max(now - then, 1e-9)))
+        self.previous = (now, values)
+        return lines
+
+    def dump(self):
+        text = self.registry.render() + ''.join(line + '\n' for line in self._rates())
+        # Replace atomically so readers never see half a file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(self.path + '.tmp', self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def close(self):
+        # The thread finishes its dump first, both write the same .tmp file
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
+
+
+class TrainingMetrics:
+    # The metrics the training loop of traffic_light_control.py updates
+    def __init__(self, registry=None):
+        registry = registry or Registry()
+        self.registry = registry
+        self.sim_steps = registry.counter('simulation_steps_total', 'Simulated seconds')
+        self.decisions = registry.counter('decisions_total', 'Actions chosen by the agent')
+        self.replay_fits = registry.counter('replay_fits_total', 'Replay minibatches fitted')
+        self.episodes = registry.counter('episodes_total', 'Finished episodes')
+        self.queue = registry.gauge('queue_vehicles', 'Halting vehicles on the incoming edges in the last second of the last action')
+        self.epsilon = registry.gauge('epsilon', 'Exploration rate')
+        self.memory_fill = registry.gauge('replay_memory_fill_ratio', 'Replay memory entries over its capacity')
+        self.waiting_time = registry.gauge('episode_waiting_time', 'Total waiting time of the last finished episode')
+        self.decision_seconds = registry.histogram('decision_seconds', 'Wall-clock time of observation and act')
+        self.replay_seconds = registry.histogram('replay_seconds', 'Wall-clock time of one replay call')
@@ -0,0 +1,189 @@
+'''
+Versioned, self-contained model artifact.
+
+One .npz file holds the weights of every layer and a JSON header with the
+format version, the input shapes, the number of actions, the layer graph
+(class, inputs, activation, strides, padding) and the Keras model config.
+Artifact loads it with NumPy alone and runs the forward pass itself, so a
+controller reaches its first decision without importing TensorFlow, building,
+tracing or compiling the network. DQNAgent.load_artifact puts the same weights
+into the Keras model when training continues.
+
+Loading validates the header and does a forward pass on zeros, any mismatch
+raises ValueError naming what does not fit instead of silently starting from
+random weights.
+
+    python model_artifact.py --weights Models/reinf_traf_control.h5 --out Models/reinf_traf_control.npz
+converts the Keras weights and compares the startup time to the first
+decision: Keras build, compile and load_weights against Artifact.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import optparse
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+FORMAT = 'tlc-dqn-artifact'
+VERSION = 1
+INPUT_SHAPES = [[12, 12, 1], [12, 12, 1], [2, 1]]
+SUPPORTED = ('InputLayer', 'Conv2D', 'Flatten', 'Concatenate', 'Dense')
+ACTIVATIONS = {'linear': lambda x: x, 'relu': lambda x: np.maximum(x, 0)}
+META_KEY = '__meta__'
+
+
+def _inbound_names(node, names):
+    # Layer names referenced by a Keras inbound_nodes entry, Keras 2 lists
+    # [name, node, tensor, kwargs] and Keras 3 keras_history [name, node, tensor]
+    found = []
+    if isinstance(node, dict):
+        for value in node.values():
+            found.extend(_inbound_names(value, names))
+    elif isinstance(node, (list, tuple)):
+        if len(node) >= 3 and node[0] in names and isinstance(node[1], int):
+            return [node[0]]
+        for value in node:
+            found.extend(_inbound_names(value, names))
+    return found
+
+
+def save(model, path, **metadata):
+    config = model.get_config()
+    names = set(layer.name for layer in model.layers)
+    inbound = dict((layer['name'], _inbound_names(layer.get('inbound_nodes', []), names))
+                   for layer in config['layers'])
+    layers = []
+    arrays = {}
+    for layer in model.layers:
+        layer_config = layer.get_config()
+        entry = {'name': layer.name, 'class': layer.__class__.__name__, 'inputs': inbound[layer.name]}
+        for key in ('activation', 'strides', 'padding', 'axis'):
+            if key in layer_config:
+                entry[key] = layer_config[key]
+        weights = layer.get_weights()
+        entry['weights'] = len(weights)
+        for i, w in enumerate(weights):
+            arrays['%s/%d' % (layer.name, i)] = w
+        layers.append(entry)
+    meta = {'format': FORMAT, 'version': VERSION, 'created': time.time(),
+            'input_shapes': [list(shape[1:]) for shape in _input_shapes(model)],
+            'action_size': int(model.outputs[0].shape[-1]),
+            'inputs': [name for name, _, _ in (i[:3] for i in config['input_layers'])],
+            'output': config['output_layers'][0][0],
+            'layers': layers, 'keras_config': model.to_json(), 'metadata': metadata}
+    arrays[META_KEY] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _input_shapes(model):
+    return [tuple(i.shape) for i in model.inputs]
+
+
+def _conv2d(x, kernel, bias, strides):
+    kh, kw = kernel.shape[:2]
+    windows = sliding_window_view(x, (kh, kw), axis=(1, 2))[:, ::strides[0], ::strides[1]]
+    # windows (n, oh, ow, c, kh, kw) against kernel (kh, kw, c, out)
+    return np.tensordot(windows, kernel, axes=((3, 4, 5), (2, 0, 1))) + bias
+
+
+class Artifact:
+    # Same act/predict interface as tflite_export.TFLiteBackend
+    def __init__(self, path, action_size=None):
+        # action_size of the loading agent, None accepts the artifact's own
+        start = time.perf_counter()
+        with np.load(path) as data:
+            if META_KEY not in data.files:
+                raise ValueError('%s is not a model artifact (no header)' % path)
+            self.meta = json.loads(data[META_KEY].tobytes().decode())
+            self.weights = dict((name, data[name].astype(np.float32)) for name in data.files if name != META_KEY)
+        self.path = path
+        self._validate(action_size)
+        self.load_seconds = time.perf_counter() - start
+
+    def _validate(self, action_size):
+        meta = self.meta
+        if meta.get('format') != FORMAT:
+            raise ValueError('%s: unknown format %r' % (self.path, meta.get('format')))
+        if meta['version'] > VERSION:
+            raise ValueError('%s: artifact version %d is newer than the supported %d' % (
+                self.path, meta['version'], VERSION))
+        if meta['input_shapes'] != INPUT_SHAPES:
+            raise ValueError('%s: input shapes %s, the observation has %s' % (
+                self.path, meta['input_shapes'], INPUT_SHAPES))
+        if action_size is not None and meta['action_size'] != action_size:
+            raise ValueError('%s: %d actions, the agent has %d' % (self.path, meta['action_size'], action_size))
+        for layer in meta['layers']:
+            if layer['class'] not in SUPPORTED:
+                raise ValueError('%s: layer %s of class %s is not supported' % (self.path, layer['name'], layer['class']))
+            if layer.get('activation', 'linear') not in ACTIVATIONS:
+                raise ValueError('%s: activation %s of %s is not supported' % (
+                    self.path, layer['activation'], layer['name']))
+            if layer['class'] == 'Conv2D' and layer.get('padding') != 'valid':
+                raise ValueError('%s: padding %s of %s is not supported' % (self.path, layer['padding'], layer['name']))
+            for i in range(layer['weights']):
+                if '%s/%d' % (layer['name'], i) not in self.weights:
+                    raise ValueError('%s: weights %s/%d missing' % (self.path, layer['name'], i))
+        try:
+            q_values = self.predict([np.zeros([1] + shape, dtype=np.float32) for shape in INPUT_SHAPES])
+        except (ValueError, KeyError) as e:
+            raise ValueError('%s: forward pass failed, layer shapes do not fit: %s' % (self.path, e))
+        if q_values.shape != (1, meta['action_size']):
+            raise ValueError('%s: output shape %s' % (self.path, q_values.shape))
+
+    def predict(self, state):
+        values = dict(zip(self.meta['inputs'], [np.asarray(s, dtype=np.float32) for s in state]))
+        for layer in self.meta['layers']:
+            name = layer['name']
+            kind = layer['class']
+            if kind == 'InputLayer':
+                continue
+            inputs = [values[i] for i in layer['inputs']]
+            if kind == 'Flatten':
+                x = inputs[0].reshape(len(inputs[0]), -1)
+            elif kind == 'Concatenate':
+                x = np.concatenate(inputs, axis=layer.get('axis', -1))
+            elif kind == 'Conv2D':
+                x = _conv2d(inputs[0], self.weights[name + '/0'], self.weights[name + '/1'], layer['strides'])
+            else:
+                x = np.dot(inputs[0], self.weights[name + '/0']) + self.weights[name + '/1']
+            values[name] = ACTIVATIONS[layer.get('activation', 'linear')](x)
+        return values[self.meta['output']]
+
+    def act(self, state):
+        q_values = self.predict(state)[0]
+        return int(np.argmax(q_values)), q_values
+
+    def keras_weights(self):
+        # In the order of model.get_weights() of the saved model
+        return [self.weights['%s/%d' % (layer['name'], i)]
+                for layer in self.meta['layers'] for i in range(layer['weights'])]
+
+
+if __name__ == '__main__':
+    optParser = optparse.OptionParser()
+    optParser.add_option("--weights", default="Models/reinf_traf_control.h5")
+    optParser.add_option("--out", default="Models/reinf_traf_control.npz")
+    options, args = optParser.parse_args()
+
+    state = [np.zeros([1] + shape, dtype=np.float32) for shape in INPUT_SHAPES]
+    start = time.perf_counter()
+    from traffic_light_control import DQNAgent
+    agent = DQNAgent()
+    agent.load(options.weights)
+    agent.model.predict(state)
+    keras_seconds = time.perf_counter() - start
+    agent.save_artifact(options.out, source=options.weights)
+
+    start = time.perf_counter()
+    artifact = Artifact(options.out)
+    artifact.act(state)
+    artifact_seconds = time.perf_counter() - start
+    print('saved %s - %d layers' % (options.out, len(artifact.meta['layers'])))
+    print('first decision - keras import, build, compile and load_weights %.1f ms, artifact %.1f ms (load %.1f ms)' % (
+        keras_seconds * 1000., artifact_seconds * 1000., artifact.load_seconds * 1000.))
+    print('max |dQ| on zeros - %g' % np.abs(np.asarray(agent.model.predict(state)) - artifact.predict(state)).max())
@@ -0,0 +1,235 @@
+'''
+Observation builder writing the getState tensors into reusable buffers.
+
+SumoIntersection.getState builds two nested 12x12 lists per call and converts
+them with np.array. ObservationBuilder owns preallocated float32 buffers and
+per-vehicle scratch arrays: each build() clears one slot in place, collects
+lane, coordinate and speed of the vehicles on the incoming edges and scatters
+them into the grids with vectorized NumPy. fill() writes every intermediate
+into the scratch (ufunc out=, compress and put instead of boolean indexing),
+so its allocations are a few array views whatever the demand; the replies of
+the per-vehicle TraCI calls in build() are still Python objects made by traci.
+The returned list holds views into the buffers, laid out like getState:
+[(1,12,12,1), (1,12,12,1), (1,2,1)], and is the same list for a slot every time.
+
+Slots are used round robin, so the views of the last `slots - 1` builds stay
+valid. Copy (or encode with state_codec) whatever has to live longer.
+
+    python observation.py --steps 2000
+compares getState and the builder on a headless SUMO run: equality, time per
+call, bytes allocated per call (peak) and memory blocks still allocated after
+each call (tracemalloc snapshot difference), and checks that the peak of
+fill() alone does not grow with the number of vehicles.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import optparse
+import time
+import tracemalloc
+
+import numpy as np
+import traci
+
+GRID = 12
+CELL_LENGTH = 7
+OFFSET = 11
+SPEED_LIMIT = 14
+
+# Per incoming edge, as in getState: coordinate axis, sign of the offset, grid
+# row of lane 0 and row step per lane, and whether columns run towards the junction
+ROADS = (('1si', 0, -1, 2, -1, True),
+         ('2si', 0, 1, 3, 1, False),
+         ('3si', 1, -1, 8, -1, True),
+         ('4si', 1, 1, 9, 1, False))
+
+
+class ObservationBuilder:
+    def __init__(self, slots=2, max_vehicles=512, junction='0'):
+        self.slots = slots
+        self.slot = slots - 1
+        self.position = np.zeros((slots, GRID, GRID, 1), dtype=np.float32)
+        self.velocity = np.zeros((slots, GRID, GRID, 1), dtype=np.float32)
+        self.light = np.zeros((slots, 2, 1), dtype=np.float32)
+        self.junction = junction
+        self.junction_position = None
+        self.count = 0  # vehicles scattered by the last build()
+        # Flat per-slot views for np.put, index row * GRID + col
+        self._position_cells = [self.position[i].reshape(-1) for i in range(slots)]
+        self._velocity_cells = [self.velocity[i].reshape(-1) for i in range(slots)]
+        # What build() returns for each slot, the same list every time
+        self._views = [[self.position[i:i + 1], self.velocity[i:i + 1], self.light[i:i + 1]]
+                       for i in range(slots)]
+
+        # Per-vehicle scratch, grown only if the demand exceeds max_vehicles
+        self._allocate(max_vehicles)
+        road_count = len(ROADS)
+        self._offset = np.array([OFFSET * r[2] for r in ROADS], dtype=np.float64)
+        self._row_base = np.array([r[3] for r in ROADS], dtype=np.intp)
+        self._row_step = np.array([r[4] for r in ROADS], dtype=np.intp)
+        self._flip = np.array([r[5] for r in ROADS], dtype=bool)
+        self._center = np.zeros(road_count, dtype=np.float64)
+
+    def _allocate(self, size):
+        self.capacity = size
+        self._road = np.zeros(size, dtype=np.intp)
+        self._coord = np.zeros(size, dtype=np.float64)
+        self._lane = np.zeros(size, dtype=np.intp)
+        self._speed = np.zeros(size, dtype=np.float64)
+        self._dist = np.zeros(size, dtype=np.float64)
+        self._offsets = np.zeros(size, dtype=np.float64)
+        self._flipped = np.zeros(size, dtype=bool)
+        self._row = np.zeros(size, dtype=np.intp)
+        self._col = np.zeros(size, dtype=np.intp)
+        self._tmp = np.zeros(size, dtype=np.intp)
+        self._valid = np.zeros(size, dtype=bool)
+        self._cells = np.zeros(size, dtype=np.intp)
+        self._values = np.zeros(size, dtype=np.float64)
+
+    def build(self, slot=None):
+        if slot is None:
+            slot = self.slot = (self.slot + 1) % self.slots
+        if self.junction_position is None:
+            # The junction does not move, ask SUMO once per connection
+            self.junction_position = traci.junction.getPosition(self.junction)
+            for i, road in enumerate(ROADS):
+                self._center[i] = self.junction_position[road[1]]
+
+        n = 0
+        for i, (edge, axis, _, _, _, _) in enumerate(ROADS):
+            vehicles = traci.edge.getLastStepVehicleIDs(edge)
+            if n + len(vehicles) > self.capacity:
+                self._grow(n + len(vehicles))
+            for v in vehicles:
+                self._road[n] = i
+                self._coord[n] = traci.vehicle.getPosition(v)[axis]
+                self._lane[n] = traci.vehicle.getLaneIndex(v)
+                self._speed[n] = traci.vehicle.getSpeed(v)
+                n += 1
+        light = traci.trafficlight.getPhase(self.junction) == 4
+        self.count = n
+        return self.fill(slot, n, light)
+
+    def _grow(self, size):
+        old = (self._road, self._coord, self._lane, self._speed)
+        self._allocate(max(size, 2 * self.capacity))
+        for new, values in zip((self._road, self._coord, self._lane, self._speed), old):
+            new[:len(values)] = values
+
+    def fill(self, slot, n, light):
+        # Scatter the first n scratch vehicles into `slot`, getState's cell rule:
+        # ind = int(|center - coord + offset| / cellLength), kept while ind < 12
+        position = self.position[slot]
+        velocity = self.velocity[slot]
+        position.fill(0)
+        velocity.fill(0)
+        road = self._road[:n]
+        dist = self._dist[:n]
+        row = self._row[:n]
+        col = self._col[:n]
+        tmp = self._tmp[:n]
+        valid = self._valid[:n]
+
+        self._center.take(road, out=dist)
+        np.subtract(dist, self._coord[:n], out=dist)
+        self._offset.take(road, out=self._offsets[:n])
+        np.add(dist, self._offsets[:n], out=dist)
+        np.abs(dist, out=dist)
+        np.floor_divide(dist, CELL_LENGTH, out=dist)
+        np.less(dist, GRID, out=valid)
+        col[...] = dist
+        # Columns count from the far end of the window on roads 1 and 3
+        flip = self._flipped[:n]
+        self._flip.take(road, out=flip)
+        np.subtract(GRID - 1, col, out=tmp)
+        np.copyto(col, tmp, where=flip)
+        self._row_step.take(road, out=row)
+        np.multiply(row, self._lane[:n], out=row)
+        self._row_base.take(road, out=tmp)
+        np.add(row, tmp, out=row)
+
+        # Cells of the vehicles inside the window, compressed into scratch
+        # instead of boolean indexing, which would allocate the selection
+        np.multiply(row, GRID, out=tmp)
+        np.add(tmp, col, out=tmp)
+        m = np.count_nonzero(valid)
+        cells = self._cells[:m]
+        values = self._values[:m]
+        tmp.compress(valid, out=cells)
+        self._speed[:n].compress(valid, out=values)
+        np.divide(values, SPEED_LIMIT, out=values)
+        self._position_cells[slot].put(cells, 1)
+        self._velocity_cells[slot].put(cells, values)
+
+        self.light[slot, 0, 0] = light
+        self.light[slot, 1, 0] = not light
+        return self._views[slot]
+
+    def reset(self):
+        # New SUMO connection, the junction position is asked again
+        self.junction_position = None
+
+
+def benchmark(steps):
+    from sumolib import checkBinary
+    from traffic_light_control import SumoIntersection
+
+    sumoInt = SumoIntersection()
+    sumoInt.generate_routefile()
+    builder = ObservationBuilder()
+    traci.start([checkBinary('sumo'), "-c", "cross3ltl.sumocfg"])
+    timings = {'getState': [], 'builder': []}
+    peaks = {'getState': [], 'builder': []}
+    blocks = {'getState': [], 'builder': []}
+    fill_peaks = []
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    max_diff = 0.
+    tracemalloc.start()
+    for step in range(steps):
+        traci.simulationStep()
+        if traci.simulation.getMinExpectedNumber() == 0:
+            break
+        for name, fn in (('getState', sumoInt.getState), ('builder', builder.build)):
+            # drop the previous result first, freeing it inside the window would cancel new blocks
+            state = None
+            before = tracemalloc.take_snapshot().filter_traces(ignore)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            state = fn()
+            timings[name].append(time.perf_counter() - start)
+            peaks[name].append(tracemalloc.get_traced_memory()[1] - base)
+            after = tracemalloc.take_snapshot().filter_traces(ignore)
+            blocks[name].append(sum(stat.count_diff for stat in after.compare_to(before, 'lineno')
+                                    if stat.count_diff > 0))
+            if name == 'getState':
+                reference = state
+            else:
+                # fill() alone, on the vehicles build() just collected
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                builder.fill(builder.slot, builder.count, bool(state[2][0, 0, 0]))
+                fill_peaks.append((builder.count, tracemalloc.get_traced_memory()[1] - base))
+        max_diff = max(max_diff, max(float(np.abs(a - b).max()) for a, b in zip(reference, state)))
+    tracemalloc.stop()
+    traci.close()
+
+    for name in ('getState', 'builder'):
+        print('%-8s - %.1f us per call, %.0f bytes allocated per call (peak), %.1f allocations per call' % (
+            name, np.mean(timings[name]) * 1e6, np.mean(peaks[name]), np.mean(blocks[name])))
+    print('max difference to getState - %g over %d observations' % (max_diff, len(timings['builder'])))
+    if fill_peaks:
+        # fill() only makes a fixed set of views, its peak must not grow with the demand
+        fewest, most = min(fill_peaks), max(fill_peaks)
+        print('fill     - %d bytes peak at %d vehicles, %d bytes at %d vehicles' % (
+            fewest[1], fewest[0], most[1], most[0]))
+        if most[1] > fewest[1]:
+            print('WARNING - fill() allocates more with more vehicles')
+
+
+if __name__ == '__main__':
+    optParser = optparse.OptionParser()
+    optParser.add_option("--steps", type="int", default=2000)
+    options, args = optParser.parse_args()
+    benchmark(options.steps)
@@ -0,0 +1,152 @@
+'''
+Offline training of the DQNAgent network from recorded transitions.
+
+Reads the shards written by transition_recorder.py through a tf.data pipeline:
+shards are read in parallel, records are shuffled in a bounded buffer, decoded
+in batches with TensorFlow ops on all cores and prefetched while the previous
+batch trains. Only the shuffle buffer and a few batches are held in memory.
+
+    python offline_train.py --data recordings --epochs 5 --out Models/reinf_traf_control.h5
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import glob
+import optparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from state_codec import GRID, POSITION_BYTES, STATE_BYTES, VELOCITY_SCALE
+from transition_recorder import TRANSITION_DTYPE, read_index, read_shard
+from dqn_agent import DQNAgent
+
+RECORD_BYTES = TRANSITION_DTYPE.itemsize
+_OFFSETS = dict((name, TRANSITION_DTYPE.fields[name][1]) for name in TRANSITION_DTYPE.names)
+
+
+def shard_paths(directory):
+    # Indexed shards first, then shards that were not closed cleanly
+    paths = [os.path.join(directory, entry['shard']) for entry in read_index(directory)]
+    for path in sorted(glob.glob(os.path.join(directory, 'shard-*.gz'))):
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+def recorded_action_size(directory):
+    # Network outputs the shards were recorded with, None if the index does not say
+    sizes = set(entry['metadata'].get('action_size') for entry in read_index(directory))
+    sizes.discard(None)
+    if len(sizes) > 1:
+        raise ValueError('%s mixes shards recorded with %s actions' % (directory, sorted(sizes)))
+    return sizes.pop() if sizes else None
+
+
+def _shard_records(path):
+    for chunk in read_shard(path.decode() if isinstance(path, bytes) else path):
+        yield chunk.view(np.uint8).reshape(-1, RECORD_BYTES)
+
+
+def _decode_states(encoded):
+    # uint8 (N, STATE_BYTES) -> [position, velocity, lgts], see state_codec.decode_states
+    n = tf.shape(encoded)[0]
+    bits = tf.bitwise.right_shift(encoded[:, :POSITION_BYTES, None],
+                                  tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8))
+    position = tf.cast(tf.bitwise.bitwise_and(bits, 1), tf.float32)
+    velocity = tf.cast(encoded[:, POSITION_BYTES:STATE_BYTES - 1], tf.float32) / VELOCITY_SCALE
+    lgts = tf.one_hot(tf.cast(encoded[:, STATE_BYTES - 1], tf.int32), 2)
+    return (tf.reshape(position, [n, GRID, GRID, 1]),
+            tf.reshape(velocity, [n, GRID, GRID, 1]),
+            tf.reshape(lgts, [n, 2, 1]))
+
+
+def _decode_batch(records):
+    def field(name, size):
+        return records[:, _OFFSETS[name]:_OFFSETS[name] + size]
+
+    reward = tf.bitcast(field('reward', 4), tf.float32)
+    return {'state': _decode_states(field('state', STATE_BYTES)),
+            'action': tf.cast(field('action', 1)[:, 0], tf.int32),
+            'reward': tf.reshape(reward, [-1]),
+            'next_state': _decode_states(field('next_state', STATE_BYTES)),
+            'done': tf.cast(field('done', 1)[:, 0], tf.float32)}
+
+
+def make_dataset(paths, batch_size, shuffle_buffer=100000, parallel_reads=4):
+    signature = tf.TensorSpec(shape=(None, RECORD_BYTES), dtype=tf.uint8)
+    dataset = tf.data.Dataset.from_tensor_slices(paths)
+    dataset = dataset.shuffle(len(paths))
+    dataset = dataset.interleave(
+        lambda path: tf.data.Dataset.from_generator(_shard_records, args=(path,),
+                                                    output_signature=signature),
+        cycle_length=parallel_reads, num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False)
+    dataset = dataset.unbatch()
+    dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(_decode_batch, num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=False)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def train(agent, dataset, epochs=1, target_sync=500):
+    # Fitted Q iteration on large batches against a periodically synced copy of
+    # the network, rows of target_f follow DQNAgent.replay.
+    target_model = tf.keras.models.clone_model(agent.model)
+    target_model.set_weights(agent.model.get_weights())
+    batches = 0
+    for epoch in range(epochs):
+        start = time.time()
+        losses = []
+        for batch in dataset:
+            next_q = target_model(list(batch['next_state']), training=False)
+            target = batch['reward'] + agent.gamma * (1. - batch['done']) * tf.reduce_max(next_q, axis=1)
+            target_f = agent.model(list(batch['state']), training=False).numpy()
+            target_f[np.arange(len(target_f)), batch['action'].numpy()] = target.numpy()
+            losses.append(agent.model.train_on_batch(list(batch['state']), target_f))
+            batches += 1
+            if batches % target_sync == 0:
+                target_model.set_weights(agent.model.get_weights())
+        print('epoch - ' + str(epoch) + ' batches - ' + str(len(losses)) + ' loss - ' +
+              str(np.mean(losses) if losses else float('nan')) +
+              ' time - %.1fs' % (time.time() - start))
+
+
+def get_options():
+    optParser = optparse.OptionParser()
+    optParser.add_option("--data", default="recordings",
+                         help="directory with shards written by --record-dir")
+    optParser.add_option("--out", default="Models/reinf_traf_control.h5",
+                         help="weights file to write, loadable by DQNAgent.load")
+    optParser.add_option("--init", default=None,
+                         help="weights to start from instead of a random network")
+    optParser.add_option("--action-size", type="int", default=None,
+                         help="network outputs, by default from the shard index (2 if it does not say)")
+    optParser.add_option("--epochs", type="int", default=1)
+    optParser.add_option("--batch-size", type="int", default=1024)
+    optParser.add_option("--shuffle-buffer", type="int", default=100000,
+                         help="records held for shuffling, bounds memory use")
+    optParser.add_option("--target-sync", type="int", default=500,
+                         help="batches between target network updates")
+    options, args = optParser.parse_args()
+    return options
+
+
+if __name__ == '__main__':
+    options = get_options()
+    paths = shard_paths(options.data)
+    if not paths:
+        raise SystemExit('no shards found in ' + options.data)
+
+    action_size = options.action_size or recorded_action_size(options.data) or 2
+    agent = DQNAgent(action_size=action_size)
+    if options.init:
+        agent.load(options.init)
+    dataset = make_dataset(paths, options.batch_size, options.shuffle_buffer)
+    train(agent, dataset, options.epochs, options.target_sync)
+    agent.save(options.out)
+    print('saved ' + options.out)
@@ -0,0 +1,254 @@
+'''
+Local inference server for the DQNAgent network.
+
+Controllers send [position, velocity, light] observations encoded with
+state_codec over localhost TCP or a Unix socket. Requests that arrive within
+the batching window are stacked into one forward pass and each caller gets
+back its action and Q-values. A stats request returns throughput and latency.
+
+    python policy_server.py --weights Models/reinf_traf_control.h5 --listen 127.0.0.1:8900
+
+Messages are length prefixed (uint32, big endian). A request payload is b'A'
+followed by an encoded state, or b'S' for stats. The reply to b'A' is the
+action as one byte followed by the float32 Q-values, the reply to b'S' is JSON.
+A request that cannot be served gets the byte 0xff followed by the error text.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from state_codec import STATE_BYTES, decode_states, encode_state
+
+_HEADER = struct.Struct('>I')
+ERROR = b'\xff'
+
+
+class PolicyError(Exception):
+    pass
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return _recv_exactly(sock, size)
+
+
+def send_message(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def parse_address(address):
+    # 'host:port' for TCP, anything else is a Unix socket path
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+class MicroBatcher:
+    def __init__(self, model, window=0.002, max_batch=256):
+        self.model = model
+        self.window = window        # seconds to wait for more requests after the first
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.started = time.time()
+        self.served = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=10000)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='micro-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, encoded):
+        # Blocks until the batch holding this request was evaluated, raises
+        # PolicyError when the batch failed
+        request = {'state': encoded, 'done': threading.Event(), 'start': time.time(), 'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise PolicyError(request['error'])
+        return request['q_values']
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                states = np.frombuffer(b''.join(r['state'] for r in batch), dtype=np.uint8)
+                q_values = np.asarray(self.model.predict_on_batch(decode_states(states)))
+            except Exception as e:
+                # Fail this batch only, the callers get the error and the loop goes on
+                for request in batch:
+                    request['error'] = '%s: %s' % (type(e).__name__, e)
+                    request['done'].set()
+                continue
+            now = time.time()
+            with self.lock:
+                self.served += len(batch)
+                self.batches += 1
+                for request in batch:
+                    self.latencies.append(now - request['start'])
+            for i, request in enumerate(batch):
+                request['q_values'] = q_values[i]
+                request['done'].set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            elapsed = time.time() - self.started
+            stats = {'requests': self.served,
+                     'batches': self.batches,
+                     'mean_batch_size': self.served / float(self.batches) if self.batches else 0.,
+                     'requests_per_second': self.served / elapsed if elapsed > 0 else 0.}
+        if len(latencies):
+            stats['latency_ms'] = {'mean': float(latencies.mean()),
+                                   'p50': float(np.percentile(latencies, 50)),
+                                   'p99': float(np.percentile(latencies, 99)),
+                                   'max': float(latencies.max())}
+        return stats
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            try:
+                payload = recv_message(self.request)
+            except EOFError:
+                return
+            if payload[:1] == b'A':
+                if len(payload) - 1 != STATE_BYTES:
+                    reply = ERROR + ('state of %d bytes, expected %d' % (len(payload) - 1, STATE_BYTES)).encode()
+                elif ord(payload[-1:]) > 1:
+                    reply = ERROR + ('light byte %d, expected 0 or 1' % ord(payload[-1:])).encode()
+                else:
+                    try:
+                        q_values = batcher.submit(payload[1:])
+                        reply = struct.pack('B', int(np.argmax(q_values))) + q_values.astype('<f4').tobytes()
+                    except PolicyError as e:
+                        reply = ERROR + str(e).encode()
+            elif payload[:1] == b'S':
+                reply = json.dumps(batcher.stats()).encode()
+            else:
+                return
+            send_message(self.request, reply)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def make_server(model, address, window=0.002, max_batch=256):
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    server.batcher = MicroBatcher(model, window, max_batch)
+    return server
+
+
+class PolicyClient:
+    # Drop-in for model.predict in DQNAgent.act
+    def __init__(self, address):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+
+    def act(self, state):
+        # Returns the action and the Q-values of a single getState observation
+        send_message(self.sock, b'A' + encode_state(state))
+        reply = recv_message(self.sock)
+        if reply[:1] == ERROR:
+            raise PolicyError(reply[1:].decode())
+        return reply[0], np.frombuffer(reply[1:], dtype='<f4')
+
+    def predict(self, state):
+        return self.act(state)[1].reshape(1, -1)
+
+    def stats(self):
+        send_message(self.sock, b'S')
+        return json.loads(recv_message(self.sock).decode())
+
+    def close(self):
+        self.sock.close()
+
+
+def get_options():
+    optParser = optparse.OptionParser()
+    optParser.add_option("--weights", default="Models/reinf_traf_control.h5")
+    optParser.add_option("--listen", default="127.0.0.1:8900",
+                         help="host:port or path of a Unix socket")
+    optParser.add_option("--window-ms", type="float", default=2.,
+                         help="time to collect concurrent requests into one batch")
+    optParser.add_option("--max-batch", type="int", default=256)
+    optParser.add_option("--stats-every", type="float", default=30.,
+                         help="seconds between stats lines, 0 to disable")
+    options, args = optParser.parse_args()
+    return options
+
+
+if __name__ == '__main__':
+    from traffic_light_control import DQNAgent
+
+    options = get_options()
+    agent = DQNAgent()
+    agent.load(options.weights)
+    server = make_server(agent.model, options.listen, options.window_ms / 1000., options.max_batch)
+    print('serving ' + options.weights + ' on ' + options.listen)
+
+    if options.stats_every > 0:
+        def report():
+            while True:
+                time.sleep(options.stats_every)
+                print(json.dumps(server.batcher.stats()))
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
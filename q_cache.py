@@ -0,0 +1,52 @@
+'''
+Bounded LRU cache of Q-values in front of the model.
+
+Observations are keyed by their state_codec encoding: bit-packed positions,
+velocities quantized to 1 / VELOCITY_SCALE and the light, 163 bytes. Two
+observations that only differ below the velocity quantization share an entry.
+The owner calls invalidate() whenever the weights change (DQNAgent does after
+replay, load and load_artifact), so the cache only pays off while the weights
+stay put: evaluation and control runs, or the stretch before replay starts.
+'''
+
+from collections import OrderedDict
+
+from state_codec import encode_state
+
+
+class QValueCache:
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def q_values(self, state, predict):
+        # Cached Q-values of a single observation, predict(state) on a miss
+        key = encode_state(state)
+        q = self.entries.get(key)
+        if q is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return q
+        self.misses += 1
+        q = predict(state)
+        self.entries[key] = q
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return q
+
+    def invalidate(self):
+        if self.entries:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self, reset=False):
+        # hits, misses and hit rate, reset=True starts counting anew (per episode)
+        total = self.hits + self.misses
+        stats = {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / float(max(total, 1)),
+                 'entries': len(self.entries), 'invalidations': self.invalidations}
+        if reset:
+            self.hits = self.misses = self.invalidations = 0
+        return stats
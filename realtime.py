@@ -0,0 +1,129 @@
+'''
+Decision deadline for controllers running against a real-time clock.
+
+DeadlineScheduler times every decision from the start of the observation.
+Inference runs on one worker thread and is waited for with the remaining
+budget. When the observation alone used up the deadline, the inference does
+not answer in time, or a late inference of an earlier decision still occupies
+the worker, the decision is a miss and the caller falls back to the static
+tlLogic program of net.net.xml (traffic_light_control.fallback_segments). Late
+results are dropped.
+
+Latencies go into a histogram with logarithmic buckets, printed at the end of
+the run and optionally written to JSON with the miss counts.
+
+A late inference keeps the worker busy while the main thread goes on; with
+training enabled this overlaps agent.replay, so deadlines are meant for runs
+that mostly act (small epsilon, loaded weights).
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import bisect
+import json
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Upper bucket edges in milliseconds, the last bucket is open
+BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def static_program(net_file='net.net.xml', tls='0'):
+    # Phase durations of the tlLogic of `tls`, by phase index
+    for logic in ET.parse(net_file).getroot().iter('tlLogic'):
+        if logic.get('id') == tls:
+            return [int(float(phase.get('duration'))) for phase in logic.iter('phase')]
+    raise ValueError('no tlLogic %s in %s' % (tls, net_file))
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum_ms = 0.
+        self.max_ms = 0.
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q):
+        # Upper edge of the bucket holding the q-th percentile
+        rank = q / 100. * self.total
+        seen = 0
+        for edge, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return edge
+        return self.max_ms
+
+    def lines(self):
+        lower = 0
+        for edge, count in zip(self.buckets + (float('inf'),), self.counts):
+            if count:
+                yield '  %7s - %-7s ms %d' % (lower, edge, count)
+            lower = edge
+
+    def to_dict(self):
+        return {'buckets_ms': list(self.buckets), 'counts': self.counts, 'total': self.total,
+                'mean_ms': self.sum_ms / max(self.total, 1), 'max_ms': self.max_ms}
+
+
+class DeadlineScheduler:
+    def __init__(self, deadline_ms):
+        self.deadline = deadline_ms / 1000.
+        self.deadline_ms = deadline_ms
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.late = None  # inference that missed its deadline and still runs
+        self.histogram = LatencyHistogram()
+        self.misses = {'observation': 0, 'inference': 0, 'busy': 0}
+        self.decisions = 0
+        self.started = None
+
+    def start(self):
+        # Call before the observation, the deadline counts from here
+        self.started = time.perf_counter()
+
+    def choose(self, act, state):
+        # act(state) within what is left of the deadline, None on a miss
+        self.decisions += 1
+        action = None
+        remaining = self.deadline - (time.perf_counter() - self.started)
+        if remaining <= 0:
+            self.misses['observation'] += 1
+        elif self.late is not None and not self.late.done():
+            self.misses['busy'] += 1
+        else:
+            future = self.worker.submit(act, state)
+            try:
+                action = future.result(timeout=remaining)
+                self.late = None
+            except TimeoutError:
+                self.late = future
+                self.misses['inference'] += 1
+        self.histogram.add((time.perf_counter() - self.started) * 1000.)
+        return action
+
+    def missed(self):
+        return sum(self.misses.values())
+
+    def report(self, path=None):
+        print('deadline %.1f ms - %d of %d decisions missed (observation %d, inference %d, busy %d), '
+              'mean %.2f ms, p99 <= %s ms, max %.2f ms' % (
+                  self.deadline_ms, self.missed(), self.decisions, self.misses['observation'],
+                  self.misses['inference'], self.misses['busy'], self.histogram.sum_ms / max(self.decisions, 1),
+                  self.histogram.percentile(99), self.histogram.max_ms))
+        for line in self.histogram.lines():
+            print(line)
+        if path:
+            with open(path, 'w') as f:
+                json.dump({'deadline_ms': self.deadline_ms, 'decisions': self.decisions,
+                           'misses': self.misses, 'latency': self.histogram.to_dict()}, f, indent=1)
+
+    def close(self):
+        self.worker.shutdown(wait=False)
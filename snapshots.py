@@ -0,0 +1,77 @@
+'''
+Library of saved SUMO states to start training episodes mid-traffic.
+
+capture() runs the route file under the static tlLogic program and saves the
+simulation with traci.simulation.saveState at the requested times. The states
+and their time, vehicle count and queue are listed in library.json. Training
+episodes started with --snapshot-dir load a random state instead of filling
+the empty network from time zero.
+
+    python snapshots.py --out snapshots --times 300,600,900,1200,1800,2400
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import random
+
+import traci
+
+LIBRARY_FILE = 'library.json'
+
+
+def capture(directory, times, sumoBinary, route_file='input_routes.rou.xml', route_seed=42):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    traci.start([sumoBinary, "-c", "cross3ltl.sumocfg", "-r", route_file])
+    entries = []
+    for t in sorted(times):
+        while traci.simulation.getTime() < t:
+            traci.simulationStep()
+        name = 'state-%06d.xml.gz' % t
+        traci.simulation.saveState(os.path.join(directory, name))
+        queue = sum(traci.edge.getLastStepHaltingNumber(e) for e in ('1si', '2si', '3si', '4si'))
+        entries.append({'file': name, 'time': traci.simulation.getTime(),
+                        'vehicles': traci.vehicle.getIDCount(), 'queue': queue})
+        print('saved %s - %d vehicles, queue %d' % (name, entries[-1]['vehicles'], queue))
+    traci.close()
+    with open(os.path.join(directory, LIBRARY_FILE), 'w') as f:
+        json.dump({'route_file': route_file, 'route_seed': route_seed, 'snapshots': entries}, f, indent=1)
+    return entries
+
+
+class SnapshotLibrary:
+    def __init__(self, directory, seed=None):
+        self.directory = directory
+        with open(os.path.join(directory, LIBRARY_FILE)) as f:
+            library = json.load(f)
+        self.route_seed = library.get('route_seed')
+        self.snapshots = library['snapshots']
+        self.random = random.Random(seed)
+
+    def choose(self):
+        return self.random.choice(self.snapshots)
+
+    def load(self, snapshot):
+        # Restore a state into the running simulation, returns its time
+        traci.simulation.loadState(os.path.join(self.directory, snapshot['file']))
+        return snapshot['time']
+
+
+if __name__ == '__main__':
+    from sumolib import checkBinary
+    from traffic_light_control import SumoIntersection
+
+    optParser = optparse.OptionParser()
+    optParser.add_option("--out", default="snapshots")
+    optParser.add_option("--times", default="300,600,900,1200,1800,2400",
+                         help="comma separated simulation times to save")
+    optParser.add_option("--route-seed", type="int", default=42)
+    options, args = optParser.parse_args()
+
+    SumoIntersection().generate_routefile(options.route_seed)
+    capture(options.out, [int(t) for t in options.times.split(',')], checkBinary('sumo'),
+            route_seed=options.route_seed)
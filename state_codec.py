@@ -0,0 +1,57 @@
+'''
+Compact encoding of the observations returned by SumoIntersection.getState.
+
+An observation is a binary (12, 12) position grid, a (12, 12) velocity grid
+normalized by the speed limit and a one-hot light of length 2. Encoded, the
+position grid is bit-packed into 18 bytes, the velocities are quantized to
+uint8 and the light is stored as the index of the active phase:
+163 bytes per observation instead of ~2.3 KB.
+
+All functions work on batches, a single observation is a batch of one.
+'''
+
+import numpy as np
+
+GRID = 12
+POSITION_BYTES = GRID * GRID // 8
+VELOCITY_BYTES = GRID * GRID
+STATE_BYTES = POSITION_BYTES + VELOCITY_BYTES + 1
+
+# Normalized velocities are quantized in steps of 1 / VELOCITY_SCALE. Vehicles
+# may drive slightly above the speed limit, 255 levels cover up to 1.275.
+VELOCITY_SCALE = 200.
+
+
+def encode_states(position, velocity, lgts):
+    # (N, 12, 12, 1), (N, 12, 12, 1), (N, 2, 1) -> uint8 (N, STATE_BYTES)
+    n = position.shape[0]
+    encoded = np.empty((n, STATE_BYTES), dtype=np.uint8)
+    occupied = position.reshape(n, GRID * GRID) > 0
+    encoded[:, :POSITION_BYTES] = np.packbits(occupied, axis=1)
+    v = np.rint(velocity.reshape(n, GRID * GRID) * VELOCITY_SCALE)
+    encoded[:, POSITION_BYTES:-1] = np.clip(v, 0, 255)
+    encoded[:, -1] = lgts.reshape(n, 2)[:, 1] > 0
+    return encoded
+
+
+def decode_states(encoded, dtype=np.float32):
+    # uint8 (N, STATE_BYTES) -> [position, velocity, lgts] as model inputs
+    encoded = np.asarray(encoded, dtype=np.uint8).reshape(-1, STATE_BYTES)
+    n = encoded.shape[0]
+    position = np.unpackbits(encoded[:, :POSITION_BYTES], axis=1).astype(dtype)
+    velocity = encoded[:, POSITION_BYTES:-1].astype(dtype) / dtype(VELOCITY_SCALE)
+    lgts = np.zeros((n, 2), dtype=dtype)
+    lgts[np.arange(n), encoded[:, -1]] = 1
+    return [position.reshape(n, GRID, GRID, 1),
+            velocity.reshape(n, GRID, GRID, 1),
+            lgts.reshape(n, 2, 1)]
+
+
+def encode_state(state):
+    # Single getState observation -> STATE_BYTES long bytes
+    return encode_states(*state)[0].tobytes()
+
+
+def decode_state(data, dtype=np.float32):
+    # Inverse of encode_state, returns a batch of one
+    return decode_states(np.frombuffer(data, dtype=np.uint8), dtype)
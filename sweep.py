@@ -0,0 +1,228 @@
+'''
+Parallel hyperparameter sweep over the training loop of traffic_light_control.py.
+
+Trials are drawn from a grid or at random from a JSON spec and run in a local
+process pool, each with its own headless SUMO and a directory for its route
+and other generated files. Every episode is written to a SQLite table so a
+trial whose running waiting time is worse than the static baseline (route seed
+42 only) or than the median of the other trials at the same episode is stopped
+early. Results end up in the `trials` table of the database.
+
+    python sweep.py --spec sweep.json --workers 4 --out sweep
+
+Example spec, lists are choices and dicts are ranges for random search:
+
+    {"mode": "random", "trials": 16, "episodes": 200,
+     "params": {"gamma": [0.9, 0.95, 0.99],
+                "learning_rate": {"loguniform": [0.0001, 0.001]},
+                "memory_size": {"int": [200, 5000]},
+                "batch_size": [32, 64], "tg": [10, 15], "ty": [4, 6]}}
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import itertools
+import json
+import math
+import multiprocessing
+import optparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from early_termination import STATIC_ROUTE_SEED, STATIC_WAITING_TIME
+
+AGENT_PARAMS = ('gamma', 'epsilon', 'learning_rate', 'memory_size')
+TRAIN_PARAMS = ('batch_size', 'tg', 'ty')
+
+
+def sample_trials(spec, seed=0):
+    params = spec['params']
+    names = sorted(params)
+    if spec.get('mode', 'grid') == 'grid':
+        values = [params[name] for name in names]
+        return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+    rng = random.Random(seed)
+    trials = []
+    for i in range(spec['trials']):
+        trial = {}
+        for name in names:
+            value = params[name]
+            if isinstance(value, list):
+                trial[name] = rng.choice(value)
+            elif 'uniform' in value:
+                trial[name] = rng.uniform(*value['uniform'])
+            elif 'loguniform' in value:
+                low, high = value['loguniform']
+                trial[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+            elif 'int' in value:
+                trial[name] = rng.randint(*value['int'])
+            else:
+                raise ValueError('unknown distribution for ' + name + ': ' + str(value))
+        trials.append(trial)
+    return trials
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS episodes (trial INTEGER, episode INTEGER, '
+               'waiting_time REAL, running_mean REAL, PRIMARY KEY (trial, episode))')
+    return db
+
+
+def create_trials_table(db, names):
+    columns = ''.join(', "%s" REAL' % name for name in names)
+    db.execute('CREATE TABLE IF NOT EXISTS trials (trial INTEGER PRIMARY KEY%s, status TEXT, '
+               'episodes INTEGER, best_waiting_time REAL, final_waiting_time REAL, '
+               'seconds REAL, reason TEXT)' % columns)
+    db.commit()
+
+
+class MedianStopping:
+    # Stop a trial once its running mean waiting time, after `grace` episodes,
+    # is above stop_ratio * static baseline or above the median of the other
+    # trials' running means at the same episode. stop_ratio=None only compares
+    # against the other trials.
+    def __init__(self, db, trial, window=10, grace=20, stop_ratio=1.5, min_trials=3):
+        self.db = db
+        self.trial = trial
+        self.window = window
+        self.grace = grace
+        self.stop_ratio = stop_ratio
+        self.min_trials = min_trials
+        self.waiting_times = []
+        self.reason = None
+
+    def __call__(self, episode, waiting_time):
+        self.waiting_times.append(waiting_time)
+        running_mean = float(np.mean(self.waiting_times[-self.window:]))
+        self.db.execute('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?)',
+                        (self.trial, episode, waiting_time, running_mean))
+        self.db.commit()
+        if episode < self.grace:
+            return True
+
+        if self.stop_ratio is not None and running_mean > self.stop_ratio * STATIC_WAITING_TIME:
+            self.reason = 'running mean %.0f above %.1fx static baseline' % (running_mean, self.stop_ratio)
+            return False
+        others = [row[0] for row in self.db.execute(
+            'SELECT running_mean FROM episodes WHERE episode = ? AND trial != ?',
+            (episode, self.trial))]
+        if len(others) >= self.min_trials and running_mean > np.median(others):
+            self.reason = 'running mean %.0f above median %.0f of %d trials' % (
+                running_mean, np.median(others), len(others))
+            return False
+        return True
+
+
+def run_trial(args):
+    trial, params, config = args
+    # One SUMO, TensorFlow session and route file per worker process
+    trial_dir = os.path.join(config['out'], 'trial-%03d' % trial)
+    if not os.path.isdir(trial_dir):
+        os.makedirs(trial_dir)
+    sys.stdout = open(os.path.join(trial_dir, 'log.txt'), 'w')
+
+    from sumolib import checkBinary
+    from traffic_light_control import SumoIntersection, train
+
+    sumoInt = SumoIntersection()
+    route_file = os.path.join(trial_dir, 'input_routes.rou.xml')
+    sumoInt.generate_routefile(config['route_seed'], route_file)
+    options = sumoInt.get_options(config['train_args'])
+
+    db = connect(config['db'])
+    stopper = MedianStopping(db, trial, config['window'], config['grace'], config['stop_ratio'])
+    start = time.time()
+    waiting_times = train(options, checkBinary('sumo'), episodes=config['episodes'],
+                          agent_params=dict((k, v) for k, v in params.items() if k in AGENT_PARAMS),
+                          route_file=route_file, route_seed=config['route_seed'],
+                          weights=config['weights'], on_episode=stopper, work_dir=trial_dir,
+                          **dict((k, v) for k, v in params.items() if k in TRAIN_PARAMS))
+
+    row = dict(params)
+    row.update({'trial': trial,
+                'status': 'stopped' if stopper.reason else 'completed',
+                'episodes': len(waiting_times),
+                'best_waiting_time': min(waiting_times) if waiting_times else None,
+                'final_waiting_time': float(np.mean(waiting_times[-config['window']:])) if waiting_times else None,
+                'seconds': time.time() - start,
+                'reason': stopper.reason})
+    names = sorted(row)
+    db.execute('INSERT OR REPLACE INTO trials (%s) VALUES (%s)' % (
+        ', '.join('"%s"' % name for name in names), ', '.join('?' * len(names))),
+        [row[name] for name in names])
+    db.commit()
+    db.close()
+    return row
+
+
+def get_options():
+    optParser = optparse.OptionParser()
+    optParser.add_option("--spec", help="JSON file with the mode, params and trials of the sweep")
+    optParser.add_option("--out", default="sweep", help="directory for trial logs and results.db")
+    optParser.add_option("--workers", type="int", default=multiprocessing.cpu_count())
+    optParser.add_option("--episodes", type="int", default=None, help="episodes per trial")
+    optParser.add_option("--window", type="int", default=10,
+                         help="episodes in the running mean used for early stopping")
+    optParser.add_option("--grace", type="int", default=20,
+                         help="episodes before a trial may be stopped")
+    optParser.add_option("--stop-ratio", type="float", default=None,
+                         help="stop trials whose running mean exceeds this multiple of the static baseline "
+                              "(default 1.5, only with route seed %d)" % STATIC_ROUTE_SEED)
+    optParser.add_option("--warm-start", action="store_true", default=False,
+                         help="start every trial from Models/reinf_traf_control.h5")
+    optParser.add_option("--seed", type="int", default=0)
+    options, args = optParser.parse_args()
+    # Remaining arguments are passed on to traffic_light_control, e.g. --max-queue 60
+    return options, args
+
+
+if __name__ == '__main__':
+    options, train_args = get_options()
+    with open(options.spec) as f:
+        spec = json.load(f)
+    trials = sample_trials(spec, options.seed)
+    route_seed = spec.get('route_seed', STATIC_ROUTE_SEED)
+    stop_ratio = options.stop_ratio
+    if route_seed != STATIC_ROUTE_SEED:
+        # the static baseline was measured on the routes of one seed only
+        if stop_ratio is not None:
+            raise SystemExit('--stop-ratio compares with the static baseline of route seed %d, '
+                             'the spec uses %d' % (STATIC_ROUTE_SEED, route_seed))
+    elif stop_ratio is None:
+        stop_ratio = 1.5
+    if not os.path.isdir(options.out):
+        os.makedirs(options.out)
+
+    config = {'out': options.out,
+              'db': os.path.join(options.out, 'results.db'),
+              'episodes': options.episodes or spec.get('episodes', 2000),
+              'route_seed': route_seed,
+              'weights': 'Models/reinf_traf_control.h5' if options.warm_start else None,
+              'window': options.window,
+              'grace': options.grace,
+              'stop_ratio': stop_ratio,
+              'train_args': ['--nogui'] + train_args}
+    db = connect(config['db'])
+    create_trials_table(db, sorted(spec['params']))
+    # trials interrupted before they finished only have rows in episodes
+    first = max(db.execute('SELECT MAX(trial) FROM trials').fetchone()[0] or 0,
+                db.execute('SELECT MAX(trial) FROM episodes').fetchone()[0] or 0) + 1
+    db.close()
+
+    print('running %d trials on %d workers, results in %s' % (len(trials), options.workers, config['db']))
+    pool = multiprocessing.Pool(options.workers, maxtasksperchild=1)
+    jobs = [(first + i, trial, config) for i, trial in enumerate(trials)]
+    for row in pool.imap_unordered(run_trial, jobs):
+        print('trial %d %s after %d episodes, final waiting time %s %s' % (
+            row['trial'], row['status'], row['episodes'], row['final_waiting_time'],
+            json.dumps(dict((k, row[k]) for k in spec['params']))))
+    pool.close()
+    pool.join()
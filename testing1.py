@@ -15,15 +15,19 @@ import numpy as np
 import keras
 import h5py
 from collections import deque
+from keras import backend as K
 from keras.layers import Input, Conv2D, Flatten, Dense
 from keras.models import Model
 import matplotlib.pyplot as plt
 
+from memory_monitor import MemoryMonitor
+
 # Global lists for realtime plotting of vehicle queue data
 steps_before = []   # simulation steps at which we record "before" queue values
 queue_before = []   # corresponding queue counts before action
 steps_after = []    # simulation steps at which we record "after" queue values
 queue_after = []    # corresponding queue counts after action
+# With --bounded-memory the four become deques holding the last --plot-window values
 
 # Setup realtime plotting
 plt.ion()  # interactive mode on
@@ -63,6 +67,7 @@ class DQNAgent:
         self.memory = deque(maxlen=200)
         self.model = self._build_model()
         self.action_size = 2
+        self.bounded = False  # predict_on_batch, no per-call predict loop state
 
     def _build_model(self):
         # Neural Net for Deep-Q learning Model
@@ -88,13 +93,26 @@ class DQNAgent:
         model.compile(optimizer=keras.optimizers.RMSprop(lr=self.learning_rate), loss='mse')
         return model
 
+    def predict(self, state):
+        if self.bounded:
+            return np.asarray(self.model.predict_on_batch(state))
+        return self.model.predict(state)
+
+    def clear_session(self):
+        # Drop the graph and trace state Keras accumulates over many predict/fit
+        # calls, the weights carry over and the optimizer starts fresh
+        weights = self.model.get_weights()
+        K.clear_session()
+        self.model = self._build_model()
+        self.model.set_weights(weights)
+
     def remember(self, state, action, reward, next_state, done):
         self.memory.append((state, action, reward, next_state, done))
 
     def act(self, state):
         if np.random.rand() <= self.epsilon:
             return random.randrange(self.action_size)
-        act_values = self.model.predict(state)
+        act_values = self.predict(state)
         return np.argmax(act_values[0])  # returns action
 
     def replay(self, batch_size):
@@ -102,8 +120,8 @@ class DQNAgent:
         for state, action, reward, next_state, done in minibatch:
             target = reward
             if not done:
-                target = (reward + self.gamma * np.amax(self.model.predict(next_state)[0]))
-            target_f = self.model.predict(state)
+                target = (reward + self.gamma * np.amax(self.predict(next_state)[0]))
+            target_f = self.predict(state)
             target_f[0][action] = target
             self.model.fit(state, target_f, epochs=1, verbose=0)
 
@@ -162,6 +180,16 @@ class SumoIntersection:
         optParser = optparse.OptionParser()
         optParser.add_option("--nogui", action="store_true",
                              default=False, help="run the commandline version of sumo")
+        optParser.add_option("--bounded-memory", action="store_true", default=False,
+                             help="rolling plot data, periodic Keras session clearing and memory reports")
+        optParser.add_option("--plot-window", type="int", default=2000,
+                             help="queue values kept per plot line with --bounded-memory")
+        optParser.add_option("--clear-session-every", type="int", default=10,
+                             help="episodes between Keras session clears with --bounded-memory, 0 for never")
+        optParser.add_option("--memory-alert-mb", type="float", default=200,
+                             help="RSS growth over the first episodes that raises an alert")
+        optParser.add_option("--tracemalloc", action="store_true", default=False,
+                             help="also report the Python heap traced by tracemalloc (slower)")
         options, args = optParser.parse_args()
         return options
 
@@ -228,6 +256,15 @@ if __name__ == '__main__':
     except Exception as e:
         print('No models found: ', e)
 
+    monitor = None
+    if options.bounded_memory:
+        agent.bounded = True
+        steps_before = deque(maxlen=options.plot_window)
+        queue_before = deque(maxlen=options.plot_window)
+        steps_after = deque(maxlen=options.plot_window)
+        queue_after = deque(maxlen=options.plot_window)
+        monitor = MemoryMonitor(options.memory_alert_mb, trace=options.tracemalloc)
+
     for e in range(episodes):
         stepz = 0
         waiting_time = 0
@@ -391,6 +428,15 @@ if __name__ == '__main__':
         agent.memory.append((mem[0], mem[1], reward, mem[3], True))
         print('episode - ' + str(e) + ' total waiting time - ' + str(waiting_time))
         traci.close(wait=False)
+        if monitor is not None:
+            if options.clear_session_every and (e + 1) % options.clear_session_every == 0:
+                agent.clear_session()
+            if monitor.episode(e) and options.tracemalloc:
+                for stat in monitor.top():
+                    print('  ' + str(stat))
+    if monitor is not None:
+        print('memory alerts - ' + str(monitor.alerts))
+        monitor.close()
     sys.stdout.flush()
     plt.ioff()
     plt.show()
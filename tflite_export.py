@@ -0,0 +1,170 @@
+'''
+Int8 TensorFlow Lite export of the DQNAgent network and an inference backend
+running the converted model.
+
+The weights are quantized to int8 with post-training quantization, calibrated
+on observations from recorded shards (--data) or from a fresh headless SUMO
+run with random actions (--simulate). Inputs and outputs stay float32 so the
+backend takes getState observations unchanged.
+
+    python tflite_export.py --weights Models/reinf_traf_control.h5 --data recordings --out Models/reinf_traf_control.tflite
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import optparse
+import os
+import random
+import time
+
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+# Names of the Input layers in DQNAgent._build_model, the converter keeps them
+# as the input names of the serving signature
+INPUT_NAMES = ('position', 'velocity', 'light')
+
+
+class TFLiteBackend:
+    # Same act/predict interface as policy_server.PolicyClient
+    def __init__(self, path, num_threads=1):
+        if Interpreter is not None:
+            self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        else:
+            import tensorflow as tf
+            self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        # The converter does not keep the input order, the signature maps the
+        # Input layer names to tensors
+        signatures = self.interpreter.get_signature_list()
+        if not signatures:
+            raise ValueError('%s has no signature, export it again with tflite_export.py' % path)
+        runner = self.interpreter.get_signature_runner(next(iter(signatures)))
+        inputs = runner.get_input_details()
+        if sorted(inputs) != sorted(INPUT_NAMES):
+            raise ValueError('%s has inputs %s, expected %s; export it again with tflite_export.py' % (
+                path, sorted(inputs), list(INPUT_NAMES)))
+        self.inputs = [inputs[name]['index'] for name in INPUT_NAMES]
+        outputs = runner.get_output_details()
+        self.output = outputs[next(iter(outputs))]['index']
+
+    def predict(self, state):
+        for index, value in zip(self.inputs, state):
+            self.interpreter.set_tensor(index, np.asarray(value, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output).copy()
+
+    def act(self, state):
+        q_values = self.predict(state)[0]
+        return int(np.argmax(q_values)), q_values
+
+
+def recorded_observations(directory, limit):
+    from state_codec import decode_states
+    from transition_recorder import read_shard
+    from offline_train import shard_paths
+
+    observations = []
+    for path in shard_paths(directory):
+        for chunk in read_shard(path):
+            states = decode_states(chunk['state'])
+            for i in range(len(chunk)):
+                observations.append([s[i:i + 1] for s in states])
+                if len(observations) >= limit:
+                    return observations
+    return observations
+
+
+def simulated_observations(limit):
+    import traci
+    from sumolib import checkBinary
+    from traffic_light_control import ACTION_PHASES, SumoIntersection
+
+    sumoInt = SumoIntersection()
+    sumoInt.generate_routefile()
+    observations = []
+    traci.start([checkBinary('sumo'), "-c", "cross3ltl.sumocfg"])
+    traci.trafficlight.setPhase("0", 0)
+    traci.trafficlight.setPhaseDuration("0", 200)
+    while len(observations) < limit and traci.simulation.getMinExpectedNumber() > 0:
+        traci.simulationStep()
+        state = sumoInt.getState()
+        observations.append([s.astype(np.float32) for s in state])
+        sumoInt.run_phase(ACTION_PHASES[random.randrange(2)]['green'], 10)
+    traci.close()
+    return observations
+
+
+def export(model, observations, path):
+    import tensorflow as tf
+
+    def representative_dataset():
+        for state in observations:
+            yield state
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def _latency_ms(fn, observations):
+    times = []
+    for state in observations:
+        start = time.perf_counter()
+        fn(state)
+        times.append(time.perf_counter() - start)
+    return np.array(times) * 1000.
+
+
+def report(model, weights_path, backend, tflite_path, observations):
+    keras_q = np.concatenate([np.asarray(model(state, training=False)) for state in observations])
+    tflite_q = np.concatenate([backend.predict(state) for state in observations])
+    agreement = np.mean(np.argmax(keras_q, axis=1) == np.argmax(tflite_q, axis=1))
+    keras_ms = _latency_ms(model.predict, observations)
+    tflite_ms = _latency_ms(backend.predict, observations)
+
+    print('size      - keras %.1f KB, tflite %.1f KB' % (
+        os.path.getsize(weights_path) / 1024., os.path.getsize(tflite_path) / 1024.))
+    print('latency   - keras predict %.3f ms (p99 %.3f), tflite %.3f ms (p99 %.3f)' % (
+        keras_ms.mean(), np.percentile(keras_ms, 99), tflite_ms.mean(), np.percentile(tflite_ms, 99)))
+    print('agreement - %.2f%% of %d actions, max |dQ| %.4f' % (
+        agreement * 100., len(observations), np.abs(keras_q - tflite_q).max()))
+
+
+def get_options():
+    optParser = optparse.OptionParser()
+    optParser.add_option("--weights", default="Models/reinf_traf_control.h5")
+    optParser.add_option("--out", default="Models/reinf_traf_control.tflite")
+    optParser.add_option("--data", default=None,
+                         help="calibrate on recorded shards in this directory")
+    optParser.add_option("--simulate", action="store_true", default=False,
+                         help="calibrate on a fresh headless SUMO run")
+    optParser.add_option("--samples", type="int", default=500,
+                         help="observations used for calibration and the report")
+    options, args = optParser.parse_args()
+    return options
+
+
+if __name__ == '__main__':
+    from traffic_light_control import DQNAgent
+
+    options = get_options()
+    if options.data:
+        observations = recorded_observations(options.data, options.samples)
+    elif options.simulate:
+        observations = simulated_observations(options.samples)
+    else:
+        raise SystemExit('calibration data needed, pass --data DIR or --simulate')
+
+    agent = DQNAgent()
+    agent.load(options.weights)
+    export(agent.model, observations, options.out)
+    report(agent.model, options.weights, TFLiteBackend(options.out), options.out, observations)
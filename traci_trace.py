@@ -0,0 +1,161 @@
+'''
+Record and replay of the TraCI calls of a run.
+
+TraceRecorder wraps the functions of the traci module and of its domains
+(edge, lane, vehicle, junction, trafficlight, simulation, lanearea) in place,
+so every module that calls traci.<domain>.<function> is covered. Each call is
+written with its arguments and result, or the TraCIException it raised, to a
+gzip file of pickled batches. The header holds the seed of `random` and
+`np.random` and the command line options of the run.
+
+TraceReplay installs the same wrappers without a simulator behind them: each
+call takes the next record, checks function and arguments and returns the
+recorded result. A run replayed with the same options, seed and starting
+weights repeats the recorded episode call by call at memory speed; the first
+call that differs raises TraceMismatch with its position. The traci Python
+package is still imported (for its constants), SUMO itself is not needed.
+
+    python traffic_light_control.py --nogui --trace-record episode.trace.gz
+    python traffic_light_control.py --nogui --trace-replay episode.trace.gz
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import gzip
+import pickle
+import random
+import time
+
+import numpy as np
+import traci
+
+DOMAINS = ('edge', 'lane', 'vehicle', 'junction', 'trafficlight', 'simulation', 'lanearea')
+TOP_LEVEL = ('start', 'load', 'close', 'switch', 'simulationStep')
+BATCH = 4096
+
+
+class TraceMismatch(Exception):
+    pass
+
+
+def _functions():
+    # (owner, attribute, name) of every wrapped function
+    for name in TOP_LEVEL:
+        yield traci, name, name
+    for domain in DOMAINS:
+        owner = getattr(traci, domain)
+        for attribute in dir(owner):
+            if not attribute.startswith('_') and callable(getattr(owner, attribute)):
+                yield owner, attribute, domain + '.' + attribute
+
+
+class _Tracer:
+    def __init__(self):
+        self.calls = 0
+        self.depth = 0
+        self.originals = []
+        self.started = time.perf_counter()
+
+    def install(self):
+        for owner, attribute, name in list(_functions()):
+            original = getattr(owner, attribute)
+            self.originals.append((owner, attribute, original))
+            setattr(owner, attribute, self._wrap(name, original))
+
+    def uninstall(self):
+        for owner, attribute, original in reversed(self.originals):
+            setattr(owner, attribute, original)
+        self.originals = []
+
+    def _wrap(self, name, original):
+        def call(*args, **kwargs):
+            if self.depth:
+                # made by traci itself inside a traced call
+                return original(*args, **kwargs)
+            self.depth += 1
+            try:
+                return self.call(name, original, args, kwargs)
+            finally:
+                self.depth -= 1
+        return call
+
+
+class TraceRecorder(_Tracer):
+    def __init__(self, path, seed=None, options=None):
+        _Tracer.__init__(self)
+        self.seed = seed if seed is not None else random.randrange(2 ** 31)
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        self.file = gzip.open(path, 'wb')
+        pickle.dump({'seed': self.seed, 'options': options}, self.file, pickle.HIGHEST_PROTOCOL)
+        self.pending = []
+        self.install()
+
+    def call(self, name, original, args, kwargs):
+        self.calls += 1
+        try:
+            result = original(*args, **kwargs)
+        except traci.TraCIException as e:
+            self._append((name, args, kwargs, None, str(e)))
+            raise
+        self._append((name, args, kwargs, result, None))
+        return result
+
+    def _append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            pickle.dump(self.pending, self.file, pickle.HIGHEST_PROTOCOL)
+            self.pending = []
+
+    def close(self):
+        self.uninstall()
+        self.flush()
+        self.file.close()
+        print('trace - recorded %d TraCI calls in %.1f s' % (self.calls, time.perf_counter() - self.started))
+
+
+class TraceReplay(_Tracer):
+    def __init__(self, path, strict=True):
+        _Tracer.__init__(self)
+        self.file = gzip.open(path, 'rb')
+        self.header = pickle.load(self.file)
+        self.seed = self.header['seed']
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        self.strict = strict  # compare arguments as well as function names
+        self.batch = []
+        self.position = 0
+        self.install()
+
+    def _next(self):
+        if self.position == len(self.batch):
+            try:
+                self.batch = pickle.load(self.file)
+            except EOFError:
+                raise TraceMismatch('call %d: the trace has ended' % self.calls)
+            self.position = 0
+        record = self.batch[self.position]
+        self.position += 1
+        return record
+
+    def call(self, name, original, args, kwargs):
+        self.calls += 1
+        recorded, rec_args, rec_kwargs, result, error = self._next()
+        if recorded != name:
+            raise TraceMismatch('call %d: %s, the trace has %s' % (self.calls, name, recorded))
+        # the SUMO binary path of start differs between machines
+        if self.strict and name != 'start' and (args != rec_args or kwargs != rec_kwargs):
+            raise TraceMismatch('call %d: %s%r, the trace has %s%r' % (self.calls, name, args, name, rec_args))
+        if error is not None:
+            raise traci.TraCIException(error)
+        return result
+
+    def close(self):
+        self.uninstall()
+        self.file.close()
+        print('trace - replayed %d TraCI calls in %.1f s' % (self.calls, time.perf_counter() - self.started))
@@ -11,78 +11,77 @@ import os
 import sys
 import optparse
 import subprocess
+import time
 import random
 import traci
+import traci.constants as tc
 import random
 import numpy as np
-import keras
-import h5py
-from collections import deque
-from keras.layers import Input, Conv2D, Flatten, Dense
-from keras.models import Model
-
-
-class DQNAgent:
-    def __init__(self):
-        self.gamma = 0.95   # discount rate
-        self.epsilon = 0.1  # exploration rate
-        self.learning_rate = 0.0002
-        self.memory = deque(maxlen=200)
-        self.model = self._build_model()
-        self.action_size = 2
-
-    def _build_model(self):
-        # Neural Net for Deep-Q learning Model
-        input_1 = Input(shape=(12, 12, 1))
-        x1 = Conv2D(16, (4, 4), strides=(2, 2), activation='relu')(input_1)
-        x1 = Conv2D(32, (2, 2), strides=(1, 1), activation='relu')(x1)
-        x1 = Flatten()(x1)
-
-        input_2 = Input(shape=(12, 12, 1))
-        x2 = Conv2D(16, (4, 4), strides=(2, 2), activation='relu')(input_2)
-        x2 = Conv2D(32, (2, 2), strides=(1, 1), activation='relu')(x2)
-        x2 = Flatten()(x2)
-
-        input_3 = Input(shape=(2, 1))
-        x3 = Flatten()(input_3)
-
-        x = keras.layers.concatenate([x1, x2, x3])
-        x = Dense(128, activation='relu')(x)
-        x = Dense(64, activation='relu')(x)
-        x = Dense(2, activation='linear')(x)
-
-        model = Model(inputs=[input_1, input_2, input_3], outputs=[x])
-        model.compile(optimizer=keras.optimizers.RMSprop(
-            lr=self.learning_rate), loss='mse')
-
-        return model
-
-    def remember(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
-
-    def act(self, state):
-        if np.random.rand() <= self.epsilon:
-            return random.randrange(self.action_size)
-        act_values = self.model.predict(state)
-
-        return np.argmax(act_values[0])  # returns action
-
-    def replay(self, batch_size):
-        minibatch = random.sample(self.memory, batch_size)
-        for state, action, reward, next_state, done in minibatch:
-            target = reward
-            if not done:
-                target = (reward + self.gamma *
-                          np.amax(self.model.predict(next_state)[0]))
-            target_f = self.model.predict(state)
-            target_f[0][action] = target
-            self.model.fit(state, target_f, epochs=1, verbose=0)
-
-    def load(self, name):
-        self.model.load_weights(name)
-
-    def save(self, name):
-        self.model.save_weights(name)
+from early_termination import EarlyTermination, STATIC_WAITING_TIME
+from dqn_agent import DQNAgent
+from transition_recorder import TransitionRecorder
+from policy_server import PolicyClient
+from tflite_export import TFLiteBackend
+from distill import TreePolicy
+import model_artifact
+from q_cache import QValueCache
+from traci_trace import TraceRecorder, TraceReplay
+from realtime import DeadlineScheduler, static_program
+from metrics import FileDumper, TrainingMetrics, serve
+from observation import ObservationBuilder
+from detectors import DETECTOR_FILE, DetectorObservation, write_detectors
+from demand import DemandInjector, load_profile, write_route_definitions
+from snapshots import SnapshotLibrary
+
+
+INCOMING_EDGES = ('1si', '2si', '3si', '4si')
+APPROACHES = ('1', '2', '3', '4')
+APPROACH_EDGES = ('1fi', '2fi', '3fi', '4fi')
+OUTGOING_EDGES = ('1o', '2o', '3o', '4o')
+
+# Phases of the tlLogic of junction '0' for each action. The transition (yellow,
+# left turn green, yellow) is only run when the agent switches away from the
+# current green. The reward is taken over the green from the vehicles on the
+# first pair of reward edges and the halting vehicles on the second pair.
+ACTION_PHASES = {
+    0: {'transition': (1, 2, 3), 'green': 4,
+        'reward_edges': (('1si', '2si'), ('3si', '4si'))},
+    1: {'transition': (5, 6, 7), 'green': 0,
+        'reward_edges': (('4si', '3si'), ('2si', '1si'))},
+}
+
+
+def action_segments(action, current, tg=10, ty=6, green_durations=None):
+    # (phase, seconds, reward_edges) run for `action` while the green of
+    # `current` is shown, reward_edges is only set for the green itself.
+    # With green_durations the action also picks the green's length:
+    # action = green action * len(green_durations) + index of the duration.
+    green = tg
+    if green_durations:
+        action, index = divmod(action, len(green_durations))
+        green = green_durations[index]
+    phases = ACTION_PHASES[action]
+    segments = []
+    if action != current:
+        # Transition Phase
+        yellow, left, yellow2 = phases['transition']
+        segments = [(yellow, ty, None), (left, tg, None), (yellow2, ty, None)]
+    # Action Execution
+    segments.append((phases['green'], green, phases['reward_edges']))
+    return segments
+
+
+def green_action_size(green_durations=None):
+    return len(ACTION_PHASES) * (len(green_durations) if green_durations else 1)
+
+
+def fallback_segments(current, durations):
+    # The static program's continuation from the green of `current`: its
+    # transition phases and the next green, with the tlLogic durations
+    phases = ACTION_PHASES[1 - current]
+    segments = [(phase, durations[phase], None) for phase in phases['transition']]
+    segments.append((phases['green'], durations[phases['green']], phases['reward_edges']))
+    return segments
 
 
 class SumoIntersection:
@@ -97,16 +96,20 @@ class SumoIntersection:
         except ImportError:
             sys.exit(
                 "please declare environment variable 'SUMO_HOME' as the root directory of your sumo installation (it should contain folders 'bin', 'tools' and 'docs')")
+        # Lane lengths of the approach edges, read once by idle_jump
+        self.approach_lengths = None
+        # Halting vehicles on the incoming edges in the last second run_phase simulated
+        self.last_queue = 0
 
-    def generate_routefile(self):
-        random.seed(42)  # make tests reproducible
+    def generate_routefile(self, seed=42, path="input_routes.rou.xml"):
+        random.seed(seed)  # make tests reproducible
         N = 3600  # number of time steps
         # demand per second from different directions
         pH = 1. / 7
         pV = 1. / 11
         pAR = 1. / 30
         pAL = 1. / 25
-        with open("input_routes.rou.xml", "w") as routes:
+        with open(path, "w") as routes:
             print('''<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">
     <vType id="SUMO_DEFAULT_TYPE" accel="0.8" decel="4.5" sigma="0" length="5" minGap="2" maxSpeed="70"/>
     <route id="always_right" edges="1fi 1si 4o 4fi 4si 2o 2fi 2si 3o 3fi 3si 1o 1fi"/>
@@ -140,13 +143,179 @@ class SumoIntersection:
                     lastVeh = i
             print("</routes>", file=routes)
 
-    def get_options(self):
+    def get_options(self, args=None):
         optParser = optparse.OptionParser()
         optParser.add_option("--nogui", action="store_true",
                              default=False, help="run the commandline version of sumo")
-        options, args = optParser.parse_args()
+        optParser.add_option("--max-queue", type="int", default=None,
+                             help="end an episode once more than this many vehicles halt for --queue-patience seconds")
+        optParser.add_option("--queue-patience", type="int", default=120,
+                             help="seconds the queue may stay above --max-queue")
+        optParser.add_option("--stall-seconds", type="int", default=None,
+                             help="end an episode after this many seconds without any vehicle arriving")
+        optParser.add_option("--baseline-waiting-time", type="int", default=None,
+                             help="end an episode once its waiting time exceeds this baseline (static program: %d)" % STATIC_WAITING_TIME)
+        optParser.add_option("--compact-memory", action="store_true", default=False,
+                             help="keep replay memory states bit-packed and quantized")
+        optParser.add_option("--record-dir", default=None,
+                             help="stream every transition to compressed shards in this directory")
+        optParser.add_option("--record-shard-mb", type="int", default=64,
+                             help="compressed size in MB after which a recording shard is rotated")
+        optParser.add_option("--policy-server", default=None,
+                             help="host:port or socket path of policy_server.py to choose actions")
+        optParser.add_option("--tflite", default=None,
+                             help="choose actions with this int8 model from tflite_export.py")
+        optParser.add_option("--artifact", default=None,
+                             help="start from the weights of this model_artifact.py file, failing on any mismatch")
+        optParser.add_option("--artifact-policy", action="store_true", default=False,
+                             help="choose actions with the NumPy forward pass of --artifact instead of Keras")
+        optParser.add_option("--no-train", action="store_true", default=False,
+                             help="only act, no replay; with --artifact-policy Keras is never loaded")
+        optParser.add_option("--green-durations", default=None,
+                             help="comma separated green lengths in seconds the agent chooses from along with the phase, e.g. 5,10,20,40")
+        optParser.add_option("--trace-record", default=None,
+                             help="write every TraCI call and its result to this trace file")
+        optParser.add_option("--trace-replay", default=None,
+                             help="answer TraCI calls from this trace file instead of SUMO")
+        optParser.add_option("--trace-seed", type="int", default=None,
+                             help="seed of random and np.random while recording a trace")
+        optParser.add_option("--q-cache", type="int", default=0,
+                             help="keep Q-values of up to this many encoded observations until the weights change")
+        optParser.add_option("--distilled", default=None,
+                             help="choose actions with this decision tree from distill.py")
+        optParser.add_option("--subscribed-stepping", action="store_true", default=False,
+                             help="hold each phase segment with one setPhase and read per-second counts from subscriptions")
+        optParser.add_option("--demand-injection", action="store_true", default=False,
+                             help="add vehicles through TraCI ahead of departure instead of writing them to the route file")
+        optParser.add_option("--demand-profile", default=None,
+                             help="JSON arrival rate profile for --demand-injection (see demand.py)")
+        optParser.add_option("--demand-horizon", type="int", default=3600,
+                             help="seconds with departures for --demand-injection, 0 for unbounded")
+        optParser.add_option("--persistent-sumo", action="store_true", default=False,
+                             help="start SUMO once and reset it between episodes with traci.load")
+        optParser.add_option("--sumo-seed", type="int", default=None,
+                             help="SUMO random seed, incremented every episode when given")
+        optParser.add_option("--snapshot-dir", default=None,
+                             help="start every episode from a random state of this snapshots.py library")
+        optParser.add_option("--obs-builder", action="store_true", default=False,
+                             help="build observations into reusable float32 buffers instead of getState")
+        optParser.add_option("--obs-detectors", action="store_true", default=False,
+                             help="observe through generated lane-area detectors, one per grid cell, instead of per-vehicle queries")
+        optParser.add_option("--idle-jump", type="int", default=0,
+                             help="while no vehicle is in the observation grid keep the phase and skip up to this many seconds at once")
+        optParser.add_option("--deadline-ms", type="float", default=None,
+                             help="wall-clock budget for observation and inference, the static program runs on a miss")
+        optParser.add_option("--deadline-report", default=None,
+                             help="write the deadline misses and the decision latency histogram to this JSON file")
+        optParser.add_option("--metrics-port", type="int", default=None,
+                             help="serve live metrics in the Prometheus text format on this localhost port")
+        optParser.add_option("--metrics-file", default=None,
+                             help="also write the metrics to this file every --metrics-interval seconds")
+        optParser.add_option("--metrics-interval", type="float", default=10.)
+        options, args = optParser.parse_args(args)
         return options
 
+    def run_phase(self, phase, duration, monitor=None, reward_edges=None):
+        # Hold the light in `phase` for `duration` simulated seconds. Returns the
+        # seconds simulated, the halting vehicles summed over them and, when
+        # reward_edges is given, reward1 and reward2 of the segment.
+        steps = 0
+        waiting_time = 0
+        reward1 = 0
+        reward2 = 0
+        if reward_edges is not None:
+            reward1 = sum(traci.edge.getLastStepVehicleNumber(e) for e in reward_edges[0])
+            reward2 = sum(traci.edge.getLastStepHaltingNumber(e) for e in reward_edges[1])
+        for i in range(duration):
+            steps += 1
+            traci.trafficlight.setPhase('0', phase)
+            if reward_edges is not None:
+                reward1 += sum(traci.edge.getLastStepVehicleNumber(e) for e in reward_edges[0])
+                reward2 += sum(traci.edge.getLastStepHaltingNumber(e) for e in reward_edges[1])
+            queue = (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
+                '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
+            waiting_time += queue
+            self.last_queue = queue
+            traci.simulationStep()
+            if monitor is not None and monitor.update(queue, traci.simulation.getArrivedNumber()):
+                break
+        return steps, waiting_time, reward1, reward2
+
+    def subscribe(self):
+        # Values read by run_phase_subscribed, SUMO sends them along with the
+        # reply to every simulationStep
+        for edge in INCOMING_EDGES:
+            traci.edge.subscribe(edge, [tc.LAST_STEP_VEHICLE_NUMBER, tc.LAST_STEP_VEHICLE_HALTING_NUMBER])
+        traci.simulation.subscribe([tc.VAR_ARRIVED_VEHICLES_NUMBER])
+
+    def run_phase_subscribed(self, phase, duration, monitor=None, reward_edges=None):
+        # Same accounting as run_phase with one round trip per simulated second:
+        # the phase is set once and held, the halting and vehicle counts come
+        # from the edge subscriptions returned by each step. Needs subscribe().
+        steps = 0
+        waiting_time = 0
+        reward1 = 0
+        reward2 = 0
+        traci.trafficlight.setPhase('0', phase)
+        # run_phase keeps restarting the phase, hold it until the next setPhase
+        traci.trafficlight.setPhaseDuration('0', 1000)
+        edges = traci.edge.getAllSubscriptionResults()
+        if reward_edges is not None:
+            reward1 = sum(edges[e][tc.LAST_STEP_VEHICLE_NUMBER] for e in reward_edges[0])
+            reward2 = sum(edges[e][tc.LAST_STEP_VEHICLE_HALTING_NUMBER] for e in reward_edges[1])
+        for i in range(duration):
+            steps += 1
+            if reward_edges is not None:
+                reward1 += sum(edges[e][tc.LAST_STEP_VEHICLE_NUMBER] for e in reward_edges[0])
+                reward2 += sum(edges[e][tc.LAST_STEP_VEHICLE_HALTING_NUMBER] for e in reward_edges[1])
+            queue = sum(edges[e][tc.LAST_STEP_VEHICLE_HALTING_NUMBER] for e in INCOMING_EDGES)
+            waiting_time += queue
+            self.last_queue = queue
+            traci.simulationStep()
+            edges = traci.edge.getAllSubscriptionResults()
+            if monitor is not None and monitor.update(
+                    queue, traci.simulation.getSubscriptionResults()[tc.VAR_ARRIVED_VEHICLES_NUMBER]):
+                break
+        return steps, waiting_time, reward1, reward2
+
+    def idle_jump(self, max_jump, window=84, max_speed=20.):
+        # Seconds the simulation can skip while the observation grid is empty:
+        # the time the nearest vehicle needs at max_speed to reach the last
+        # `window` metres before the stop line. Edge X o leads into X fi and
+        # X fi into X si, so a vehicle on X fi also has all of X si ahead and
+        # one on X o all of X fi and X si. Of the junction internals :mX_0
+        # joins X fi to X si, :X_0 X o to X fi, and those of the centre :0_*
+        # lead into an o edge. Vehicles still to depart start on a fi edge,
+        # the floor covers them and the centre; an unknown road counts as 0 m.
+        if self.approach_lengths is None:
+            self.approach_lengths = dict((edge, traci.lane.getLength(edge + '_0'))
+                                         for edge in INCOMING_EDGES + APPROACH_EDGES + OUTGOING_EDGES)
+        lengths = self.approach_lengths
+        nearest = min(lengths[x + 'fi'] + lengths[x + 'si'] for x in APPROACHES) - window
+        for v in traci.vehicle.getIDList():
+            edge = traci.vehicle.getRoadID(v)
+            if edge in lengths:
+                x, kind = edge[0], edge[1:]
+                ahead = lengths[edge] - traci.vehicle.getLanePosition(v) + lengths[x + 'si'] - window
+                if kind == 'si':
+                    ahead -= lengths[x + 'si']
+                elif kind == 'o':
+                    ahead += lengths[x + 'fi']
+            elif edge.startswith(':'):
+                node = edge[1:].split('_')[0]
+                if node == '0':
+                    continue
+                elif node[:1] == 'm' and node[1:] in APPROACHES:
+                    ahead = lengths[node[1:] + 'si'] - window
+                elif node in APPROACHES:
+                    ahead = lengths[node + 'fi'] + lengths[node + 'si'] - window
+                else:
+                    ahead = 0
+            else:
+                ahead = 0
+            nearest = min(nearest, ahead)
+        return max(int(min(float(max_jump), nearest / max_speed)), 1)
+
     def getState(self):
         positionMatrix = []
         velocityMatrix = []
@@ -230,33 +399,131 @@ def record_vehicle_queue(step, filename="queue_log.txt"):
     with open(filename, "a") as log_file:
         log_file.write("Step {}: Queue = {}\n".format(step, queue_count))
 
-if __name__ == '__main__':
+def train(options, sumoBinary, episodes=2000, batch_size=32, max_steps=7000, tg=10, ty=6,
+          agent_params=None, route_file='input_routes.rou.xml', route_seed=42,
+          weights='Models/reinf_traf_control.h5', on_episode=None, work_dir='.'):
+    # Run the training episodes and return the total waiting time of each.
+    # weights=None starts from a random network, on_episode(e, waiting_time)
+    # may return False to stop training early. Generated route definitions and
+    # detector files go to work_dir.
+    startup = time.time()
+    tracer = None
+    if options.trace_record:
+        tracer = TraceRecorder(options.trace_record, options.trace_seed, vars(options))
+    elif options.trace_replay:
+        tracer = TraceReplay(options.trace_replay)
     sumoInt = SumoIntersection()
-    # this script has been called from the command line. It will start sumo as a
-    # server, then connect and run
-    options = sumoInt.get_options()
-
-    if options.nogui:
-    #if True:
-        sumoBinary = checkBinary('sumo')
-    else:
-        sumoBinary = checkBinary('sumo-gui')
-    sumoInt.generate_routefile()
-
-
-    # Main logic
-    # parameters
-    episodes = 2000
-    batch_size = 32
-
-    tg = 10
-    ty = 6
-    agent = DQNAgent()
-    try:
-        agent.load('Models/reinf_traf_control.h5')
-    except:
-        print('No models found')
-
+    green_durations = None
+    agent_params = dict(agent_params or {})
+    if options.green_durations:
+        green_durations = [int(d) for d in options.green_durations.split(',')]
+        agent_params['action_size'] = green_action_size(green_durations)
+    agent = DQNAgent(compact_memory=options.compact_memory, **agent_params)
+    model_version = 'random-init'
+    if options.artifact:
+        if options.artifact_policy and options.no_train:
+            # Acting only, the weights are not needed in a Keras model
+            artifact = model_artifact.Artifact(options.artifact, agent.action_size)
+        else:
+            artifact = agent.load_artifact(options.artifact)
+        print('loaded %s (version %d) in %.1f ms' % (
+            options.artifact, artifact.meta['version'], artifact.load_seconds * 1000.))
+        model_version = os.path.basename(options.artifact) + '@%d' % artifact.meta['created']
+        if options.artifact_policy:
+            agent.policy_client = artifact
+    elif weights is not None:
+        try:
+            agent.load(weights)
+            model_version = os.path.basename(weights) + '@%d' % os.path.getmtime(weights)
+        except:
+            print('No models found')
+
+    if options.q_cache:
+        agent.q_cache = QValueCache(options.q_cache)
+
+    if options.policy_server:
+        agent.policy_client = PolicyClient(options.policy_server)
+    elif options.tflite:
+        agent.policy_client = TFLiteBackend(options.tflite)
+    elif options.distilled:
+        agent.policy_client = TreePolicy(options.distilled)
+    if green_durations and agent.policy_client is not None and not options.artifact_policy:
+        # these backends answer with the two phase actions, which action_segments
+        # would decode as the first phase with one of the green durations
+        raise ValueError('--green-durations needs the Keras model or --artifact-policy, '
+                         'not --policy-server, --tflite or --distilled')
+
+    recorder = None
+    if options.record_dir:
+        recorder = TransitionRecorder(options.record_dir, shard_bytes=options.record_shard_mb << 20)
+
+    injector = None
+    if options.demand_injection:
+        route_file = write_route_definitions(os.path.join(work_dir, 'input_routes_defs.rou.xml'))
+        injector = DemandInjector(load_profile(options.demand_profile) if options.demand_profile else None,
+                                  seed=route_seed, horizon=options.demand_horizon or None)
+
+    snapshots = None
+    if options.snapshot_dir:
+        snapshots = SnapshotLibrary(options.snapshot_dir)
+        if snapshots.route_seed is None:
+            print('snapshot library ' + options.snapshot_dir + ' does not record its route seed, not checked')
+        elif snapshots.route_seed != route_seed:
+            # other routes reuse the vehicle IDs with different vehicles
+            raise ValueError('snapshot library %s was captured with route seed %d, this run uses %d' % (
+                options.snapshot_dir, snapshots.route_seed, route_seed))
+
+    builder = None
+    get_state = sumoInt.getState
+    if options.obs_builder:
+        builder = ObservationBuilder()
+        get_state = builder.build
+        agent.copy_states = True
+    detector_obs = None
+    if options.obs_detectors:
+        detector_file = write_detectors(path=os.path.join(work_dir, DETECTOR_FILE))
+        detector_obs = DetectorObservation()
+        get_state = detector_obs.build
+        agent.copy_states = True
+
+    monitor = EarlyTermination(max_queue=options.max_queue,
+                               queue_patience=options.queue_patience,
+                               stall_seconds=options.stall_seconds,
+                               baseline_waiting_time=options.baseline_waiting_time,
+                               max_steps=max_steps)
+    if not monitor.enabled():
+        monitor = None
+
+    scheduler = None
+    if options.deadline_ms:
+        scheduler = DeadlineScheduler(options.deadline_ms)
+        static_durations = static_program()
+
+    if injector is not None:
+        # One loop iteration advances a decision step plus a macro-step or an
+        # idle jump, vehicles are added for at least that far ahead
+        longest = max(2 * ty + tg + max(green_durations or [tg]), options.idle_jump)
+        if scheduler is not None:
+            longest = max(longest, sum(static_durations))
+        injector.lookahead = max(injector.lookahead, longest + 1)
+
+    metrics = None
+    metrics_server = None
+    metrics_dumper = None
+    if options.metrics_port or options.metrics_file:
+        metrics = TrainingMetrics()
+        if options.metrics_port:
+            metrics_server = serve(metrics.registry, options.metrics_port)
+        if options.metrics_file:
+            metrics_dumper = FileDumper(metrics.registry, options.metrics_file, options.metrics_interval)
+
+    waiting_times = []
+    total_idle_seconds = 0
+    total_decisions = 0
+    total_seconds = 0
+    sumo_running = False
+    start_times = []
+    reset_times = []
     for e in range(episodes):
         # DNN Agent
         # Initialize DNN with random weights
@@ -267,139 +534,244 @@ if __name__ == '__main__':
         reward1 = 0
         reward2 = 0
         total_reward = reward1 - reward2
+        reward = None  # set by the first decision of the episode
         stepz = 0
         action = 0
-
-        traci.start([sumoBinary, "-c", "cross3ltl.sumocfg", '--start'])
+        idle_seconds = 0
+        decisions = 0
+        if monitor is not None:
+            monitor.reset()
+        if recorder is not None:
+            recorder.start_episode(route_seed=route_seed, model_version=model_version,
+                                  action_size=agent.action_size)
+
+        sumo_args = ["-c", "cross3ltl.sumocfg", "-r", route_file, '--start']
+        if options.sumo_seed is not None:
+            sumo_args += ["--seed", str(options.sumo_seed + e)]
+        if detector_obs is not None:
+            sumo_args += ["-a", detector_file]
+        reset_start = time.time()
+        if options.persistent_sumo and sumo_running:
+            # Same process; SUMO still parses the network and additional files
+            # again, but skips process start-up and the TraCI connection
+            traci.load(sumo_args)
+            reset_times.append(time.time() - reset_start)
+        else:
+            traci.start([sumoBinary] + sumo_args)
+            sumo_running = True
+            start_times.append(time.time() - reset_start)
+        start_time = 0
+        if snapshots is not None:
+            snapshot = snapshots.choose()
+            start_time = snapshots.load(snapshot)
+            print('episode - ' + str(e) + ' starting from ' + snapshot['file'] +
+                  ' (' + str(snapshot['vehicles']) + ' vehicles)')
         traci.trafficlight.setPhase("0", 0)
         traci.trafficlight.setPhaseDuration("0", 200)
-        while traci.simulation.getMinExpectedNumber() > 0 and stepz < 7000:
+        if builder is not None:
+            builder.reset()
+        if detector_obs is not None:
+            detector_obs.subscribe()
+        if injector is not None:
+            injector.reset()
+            if snapshots is not None:
+                injector.mark_present()
+            injector.skip_to(start_time)
+            injector.inject(start_time)
+        run_phase = sumoInt.run_phase
+        if options.subscribed_stepping:
+            sumoInt.subscribe()
+            run_phase = sumoInt.run_phase_subscribed
+        while ((traci.simulation.getMinExpectedNumber() > 0 or
+                (injector is not None and not injector.finished())) and stepz < max_steps):
+            if injector is not None:
+                # lookahead covers the longest macro-step and idle jump, set above
+                injector.inject(traci.simulation.getTime())
             traci.simulationStep()
-            state = sumoInt.getState()
-            action = agent.act(state)
+            if scheduler is not None:
+                scheduler.start()
+            if metrics is not None:
+                decision_start = time.perf_counter()
+            state = get_state()
+            if options.idle_jump > 0 and not state[0].any():
+                # Nothing to decide on, hold the phase and fast-forward
+                jump = min(sumoInt.idle_jump(options.idle_jump), max_steps - stepz)
+                if injector is not None:
+                    jump = min(jump, injector.lookahead - 1)
+                traci.trafficlight.setPhaseDuration('0', 1000)
+                traci.simulationStep(traci.simulation.getTime() + jump)
+                stepz += jump
+                idle_seconds += jump
+                if metrics is not None:
+                    metrics.sim_steps.inc(jump + 1)
+                if monitor is not None:
+                    monitor.skip(jump)
+                continue
             light = state[2]
-
-            if(action == 0 and light[0][0][0] == 0):
-                # Transition Phase
-                for i in range(6):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 1)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-                for i in range(10):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 2)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-                for i in range(6):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 3)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-                # Action Execution
-                reward1 = traci.edge.getLastStepVehicleNumber(
-                    '1si') + traci.edge.getLastStepVehicleNumber('2si')
-                reward2 = traci.edge.getLastStepHaltingNumber(
-                    '3si') + traci.edge.getLastStepHaltingNumber('4si')
-                for i in range(10):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 4)
-                    reward1 += traci.edge.getLastStepVehicleNumber(
-                        '1si') + traci.edge.getLastStepVehicleNumber('2si')
-                    reward2 += traci.edge.getLastStepHaltingNumber(
-                        '3si') + traci.edge.getLastStepHaltingNumber('4si')
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-            if(action == 0 and light[0][0][0] == 1):
-                # Action Execution, no state change
-                reward1 = traci.edge.getLastStepVehicleNumber(
-                    '1si') + traci.edge.getLastStepVehicleNumber('2si')
-                reward2 = traci.edge.getLastStepHaltingNumber(
-                    '3si') + traci.edge.getLastStepHaltingNumber('4si')
-                for i in range(10):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 4)
-                    reward1 += traci.edge.getLastStepVehicleNumber(
-                        '1si') + traci.edge.getLastStepVehicleNumber('2si')
-                    reward2 += traci.edge.getLastStepHaltingNumber(
-                        '3si') + traci.edge.getLastStepHaltingNumber('4si')
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-            if(action == 1 and light[0][0][0] == 0):
-                # Action Execution, no state change
-                reward1 = traci.edge.getLastStepVehicleNumber(
-                    '4si') + traci.edge.getLastStepVehicleNumber('3si')
-                reward2 = traci.edge.getLastStepHaltingNumber(
-                    '2si') + traci.edge.getLastStepHaltingNumber('1si')
-                for i in range(10):
-                    stepz += 1
-                    reward1 += traci.edge.getLastStepVehicleNumber(
-                        '4si') + traci.edge.getLastStepVehicleNumber('3si')
-                    reward2 += traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('1si')
-                    traci.trafficlight.setPhase('0', 0)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-            if(action == 1 and light[0][0][0] == 1):
-                for i in range(6):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 5)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-                for i in range(10):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 6)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-                for i in range(6):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 7)
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-                reward1 = traci.edge.getLastStepVehicleNumber(
-                    '4si') + traci.edge.getLastStepVehicleNumber('3si')
-                reward2 = traci.edge.getLastStepHaltingNumber(
-                    '2si') + traci.edge.getLastStepHaltingNumber('1si')
-                for i in range(10):
-                    stepz += 1
-                    traci.trafficlight.setPhase('0', 0)
-                    reward1 += traci.edge.getLastStepVehicleNumber(
-                        '4si') + traci.edge.getLastStepVehicleNumber('3si')
-                    reward2 += traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('1si')
-                    waiting_time += (traci.edge.getLastStepHaltingNumber('1si') + traci.edge.getLastStepHaltingNumber(
-                        '2si') + traci.edge.getLastStepHaltingNumber('3si') + traci.edge.getLastStepHaltingNumber('4si'))
-                    traci.simulationStep()
-
-            new_state = sumoInt.getState()
+            # light[0][0][0] is 1 while the green of action 0 (phase 4) is shown
+            current = 0 if light[0][0][0] == 1 else 1
+            if scheduler is not None:
+                action = scheduler.choose(agent.act, state)
+                if action is None:
+                    # Deadline missed, the static program switches to the other green
+                    segments = fallback_segments(current, static_durations)
+                    action = 1 - current
+                    if green_durations:
+                        # remembered with the choosable green closest to the static one
+                        closest = min(range(len(green_durations)),
+                                      key=lambda i: abs(green_durations[i] - segments[-1][1]))
+                        action = action * len(green_durations) + closest
+                else:
+                    segments = action_segments(action, current, tg, ty, green_durations)
+            else:
+                action = agent.act(state)
+                segments = action_segments(action, current, tg, ty, green_durations)
+            decisions += 1
+            if startup is not None:
+                print('first decision %.1f ms after train() started' % ((time.time() - startup) * 1000.))
+                startup = None
+            if metrics is not None:
+                metrics.decision_seconds.observe(time.perf_counter() - decision_start)
+                metrics.decisions.inc()
+                episode_steps = stepz
+
+            terminated = False
+            green_ran = False
+            seconds = 1  # the step of the decision
+            for phase, duration, reward_edges in segments:
+                steps, waiting, r1, r2 = run_phase(phase, duration, monitor, reward_edges)
+                stepz += steps
+                seconds += steps
+                waiting_time += waiting
+                if reward_edges is not None:
+                    reward1, reward2 = r1, r2
+                    green_ran = True
+                if monitor is not None and monitor.reason is not None:
+                    terminated = True
+                    break
+            if not green_ran:
+                # Terminated during the transition, the green never ran: take the
+                # action's reward counts now, once per second the green would
+                # have sampled them, instead of the last macro-step's reward
+                reward_edges = segments[-1][2]
+                samples = segments[-1][1] + 1
+                reward1 = samples * sum(traci.edge.getLastStepVehicleNumber(e) for e in reward_edges[0])
+                reward2 = samples * sum(traci.edge.getLastStepHaltingNumber(e) for e in reward_edges[1])
+
+            new_state = get_state()
             reward = reward1 - reward2
-            agent.remember(state, action, reward, new_state, False)
+            discount_steps = 1.
+            if green_durations:
+                # the reward accumulates over the whole green, discount by the
+                # simulated seconds it took instead, in units of tg
+                discount_steps = seconds / float(tg)
+            agent.remember(state, action, reward, new_state, terminated, discount_steps)
+            if recorder is not None:
+                if agent.copy_states:
+                    # the recorder encodes later, after the buffers were reused
+                    state = [np.array(s) for s in state]
+                    new_state = [np.array(s) for s in new_state]
+                recorder.record(state, action, reward, new_state, terminated)
             # Randomly Draw 32 samples and train the neural network by RMS Prop algorithm
-            if(len(agent.memory) > batch_size):
+            if(len(agent.memory) > batch_size) and not options.no_train:
+                if metrics is not None:
+                    replay_start = time.perf_counter()
                 agent.replay(batch_size)
-
-        mem = agent.memory[-1]
-        del agent.memory[-1]
-        agent.memory.append((mem[0], mem[1], reward, mem[3], True))
+                if metrics is not None:
+                    metrics.replay_seconds.observe(time.perf_counter() - replay_start)
+                    metrics.replay_fits.inc()
+            if metrics is not None:
+                # the step of the decision plus the macro-step
+                metrics.sim_steps.inc(stepz - episode_steps + 1)
+                # counted by run_phase, no extra round trips
+                metrics.queue.set(sumoInt.last_queue)
+                metrics.epsilon.set(agent.epsilon)
+                metrics.memory_fill.set(len(agent.memory) / float(agent.memory.maxlen))
+            if terminated:
+                break
+
+        if agent.memory and reward is not None:
+            # without a decision this episode the last entry is the previous episode's
+            mem = agent.memory[-1]
+            del agent.memory[-1]
+            agent.memory.append((mem[0], mem[1], reward, mem[3], True, mem[5]))
+        if recorder is not None:
+            recorder.end_episode(reward)
         #log.write('episode - ' + str(e) + ', total waiting time - ' +
         #          str(waiting_time) + ', static waiting time - 338798 \n')
         #log.close()
         print('episode - ' + str(e) + ' total waiting time - ' + str(waiting_time))
+        total_decisions += decisions
+        total_seconds += stepz
+        if green_durations:
+            print('episode - %d %d decisions, %.1f per simulated hour' % (e, decisions, decisions * 3600. / max(stepz, 1)))
+        if scheduler is not None:
+            print('episode - ' + str(e) + ' ' + str(scheduler.missed()) + ' deadline misses so far')
+        if agent.q_cache is not None:
+            stats = agent.q_cache.stats(reset=True)
+            print('episode - %d Q-value cache %d hits, %d misses (%.1f%%), %d invalidations' % (
+                e, stats['hits'], stats['misses'], stats['hit_rate'] * 100., stats['invalidations']))
+        if options.idle_jump > 0:
+            total_idle_seconds += idle_seconds
+            print('episode - ' + str(e) + ' fast-forwarded ' + str(idle_seconds) + ' idle simulated seconds')
+        if monitor is not None and monitor.reason is not None:
+            saved = monitor.finish_episode()
+            print('episode - ' + str(e) + ' terminated early (' + monitor.reason +
+                  '), saved ' + str(saved) + ' simulated seconds')
         #agent.save('reinf_traf_control_' + str(e) + '.h5')
+        if not options.persistent_sumo:
+            traci.close(wait=False)
+            sumo_running = False
+
+        waiting_times.append(waiting_time)
+        if metrics is not None:
+            metrics.episodes.inc()
+            metrics.waiting_time.set(waiting_time)
+        if on_episode is not None and on_episode(e, waiting_time) is False:
+            break
+
+    if recorder is not None:
+        recorder.close()
+        print('recorded transitions to ' + options.record_dir + ', dropped ' + str(recorder.dropped))
+    if sumo_running:
         traci.close(wait=False)
+    if reset_times:
+        print('episode reset - traci.load %.1f ms mean over %d episodes, '
+              'cold traci.start %.1f ms from %d start(s) only' % (
+            1000. * sum(reset_times) / len(reset_times), len(reset_times),
+            1000. * sum(start_times) / len(start_times), len(start_times)))
+    print('decisions - %d, %.1f per simulated hour' % (total_decisions, total_decisions * 3600. / max(total_seconds, 1)))
+    if options.idle_jump > 0:
+        print('idle fast-forward - ' + str(total_idle_seconds) + ' simulated seconds skipped')
+    if monitor is not None:
+        print('early termination - ' + str(monitor.terminated_episodes) + ' episodes, ' +
+              str(monitor.seconds_saved) + ' simulated seconds saved')
+    if scheduler is not None:
+        scheduler.report(options.deadline_report)
+        scheduler.close()
+    if tracer is not None:
+        tracer.close()
+    if metrics_dumper is not None:
+        metrics_dumper.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    return waiting_times
+
+
+if __name__ == '__main__':
+    sumoInt = SumoIntersection()
+    # this script has been called from the command line. It will start sumo as a
+    # server, then connect and run
+    options = sumoInt.get_options()
+
+    if options.nogui:
+    #if True:
+        sumoBinary = checkBinary('sumo')
+    else:
+        sumoBinary = checkBinary('sumo-gui')
+    sumoInt.generate_routefile()
+
+    # Main logic
+    train(options, sumoBinary)
 
-sys.stdout.flush()
+    sys.stdout.flush()
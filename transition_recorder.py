@@ -0,0 +1,187 @@
+'''
+Streaming recorder for the transitions generated by the SUMO loop.
+
+Every (state, action, reward, next_state, done) is encoded with state_codec and
+appended to gzip compressed shards in a directory. Shards are rotated by size
+and whenever the episode metadata changes, so each shard carries one set of
+tags. A closed shard is listed in index.jsonl together with its record count
+and metadata. Encoding, compression and file I/O happen on a background
+thread, the control loop only puts references on a queue.
+'''
+
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from state_codec import STATE_BYTES, encode_states
+
+TRANSITION_DTYPE = np.dtype([('state', np.uint8, (STATE_BYTES,)),
+                             ('action', np.uint8),
+                             ('reward', '<f4'),
+                             ('next_state', np.uint8, (STATE_BYTES,)),
+                             ('done', np.uint8)])
+INDEX_FILE = 'index.jsonl'
+
+_EPISODE = 'episode'
+_CLOSE = 'close'
+
+
+class TransitionRecorder:
+    def __init__(self, directory, shard_bytes=64 << 20, batch=64, max_pending=10000):
+        self.directory = directory
+        self.shard_bytes = shard_bytes   # compressed size after which a shard is rotated
+        self.batch = batch               # transitions encoded per write
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.shard_number = self._next_shard_number()
+        self.shard = None
+        self.metadata = {}
+        self.pending = None
+        self.dropped = 0
+        self.error = None  # exception that stopped the writer thread
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name='transition-recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _next_shard_number(self):
+        numbers = [int(name[6:11]) for name in os.listdir(self.directory)
+                   if name.startswith('shard-') and name.endswith('.gz')]
+        return max(numbers) + 1 if numbers else 0
+
+    # Control loop side
+
+    def start_episode(self, **metadata):
+        # Tag the following transitions, e.g. episode, route_seed, model_version
+        self._put((_EPISODE, metadata))
+
+    def record(self, state, action, reward, next_state, done=False):
+        # The latest transition is held back so end_episode can still mark it
+        # terminal, the way the main loop rewrites the last memory entry.
+        if self.pending is not None:
+            self._put(self.pending)
+        self.pending = (state, action, reward, next_state, done)
+
+    def end_episode(self, reward=None):
+        if self.pending is not None:
+            state, action, last_reward, next_state, done = self.pending
+            if reward is None:
+                reward = last_reward
+            self._put((state, action, reward, next_state, True))
+            self.pending = None
+
+    def close(self, timeout=60.):
+        # Raises the writer thread's exception instead of waiting on a queue
+        # nobody drains
+        self.end_episode()
+        if self.thread.is_alive():
+            try:
+                self.queue.put(_CLOSE, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        if self.thread.is_alive():
+            raise RuntimeError('transition recorder: writer did not finish within %.0f s' % timeout)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Never stall the simulation on a slow disk
+            self.dropped += 1
+
+    # Writer thread side
+
+    def _run(self):
+        try:
+            self._write_items()
+        except Exception as e:
+            self.error = e
+
+    def _write_items(self):
+        transitions = []
+        while True:
+            item = self.queue.get()
+            if item == _CLOSE or (isinstance(item, tuple) and item[0] == _EPISODE):
+                self._write(transitions)
+                transitions = []
+                if item == _CLOSE:
+                    self._close_shard()
+                    return
+                if item[1] != self.metadata:
+                    self._close_shard()
+                    self.metadata = item[1]
+                continue
+            transitions.append(item)
+            if len(transitions) >= self.batch:
+                self._write(transitions)
+                transitions = []
+
+    def _write(self, transitions):
+        if not transitions:
+            return
+        records = np.zeros(len(transitions), dtype=TRANSITION_DTYPE)
+        states = [t[0] for t in transitions]
+        next_states = [t[3] for t in transitions]
+        records['state'] = encode_states(*[np.concatenate([s[i] for s in states]) for i in range(3)])
+        records['next_state'] = encode_states(*[np.concatenate([s[i] for s in next_states]) for i in range(3)])
+        records['action'] = [t[1] for t in transitions]
+        records['reward'] = [t[2] for t in transitions]
+        records['done'] = [t[4] for t in transitions]
+
+        if self.shard is None:
+            self._open_shard()
+        self.shard['file'].write(records.tobytes())
+        self.shard['records'] += len(records)
+        if self.shard['raw'].tell() >= self.shard_bytes:
+            self._close_shard()
+
+    def _open_shard(self):
+        name = 'shard-%05d.gz' % self.shard_number
+        self.shard_number += 1
+        raw = open(os.path.join(self.directory, name), 'ab')
+        self.shard = {'name': name, 'raw': raw, 'records': 0, 'created': time.time(),
+                      'file': gzip.GzipFile(fileobj=raw, mode='ab')}
+
+    def _close_shard(self):
+        if self.shard is None:
+            return
+        self.shard['file'].close()
+        self.shard['raw'].close()
+        entry = {'shard': self.shard['name'],
+                 'records': self.shard['records'],
+                 'bytes': os.path.getsize(os.path.join(self.directory, self.shard['name'])),
+                 'created': self.shard['created'],
+                 'metadata': self.metadata}
+        with open(os.path.join(self.directory, INDEX_FILE), 'a') as index:
+            index.write(json.dumps(entry) + '\n')
+        self.shard = None
+
+
+def read_index(directory):
+    # Entries of all closed shards, oldest first
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as index:
+        return [json.loads(line) for line in index if line.strip()]
+
+
+def read_shard(path, chunk_records=4096):
+    # Yield structured TRANSITION_DTYPE arrays of up to chunk_records transitions
+    chunk_bytes = chunk_records * TRANSITION_DTYPE.itemsize
+    with gzip.open(path, 'rb') as shard:
+        while True:
+            data = shard.read(chunk_bytes)
+            # A shard cut short by a crash may end in a partial record
+            data = data[:len(data) - len(data) % TRANSITION_DTYPE.itemsize]
+            if not data:
+                return
+            yield np.frombuffer(data, dtype=TRANSITION_DTYPE)
@@ -0,0 +1,165 @@
+'''
+K SUMO instances stepped in lockstep, with one batched forward pass per step.
+
+VectorSumoEnv keeps one TraCI connection per instance (labels env0, env1, ...)
+and runs the macro-step of traffic_light_control.py on each: optional
+transition, green, reward and waiting time accounting. Observations of all
+instances are written into one ObservationBuilder, so the batched
+[position, velocity, lgts] handed to DQNAgent.act_batch are views without any
+stacking. Finished episodes are reset in place.
+
+    python vector_env.py --envs 4 --steps 500
+trains for 500 lockstep steps, --benchmark compares the environment steps per
+second with the same number of steps on K independent single-instance runs.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import optparse
+import time
+
+import numpy as np
+import traci
+
+from observation import ObservationBuilder
+from traffic_light_control import DQNAgent, SumoIntersection, action_segments
+
+
+class VectorSumoEnv:
+    def __init__(self, num_envs, sumoBinary, route_file='input_routes.rou.xml',
+                 max_steps=7000, tg=10, ty=6):
+        self.num_envs = num_envs
+        self.labels = ['env%d' % i for i in range(num_envs)]
+        self.sumoBinary = sumoBinary
+        self.route_file = route_file
+        self.max_steps = max_steps
+        self.tg = tg
+        self.ty = ty
+        self.sumoInt = SumoIntersection()
+        # Two halves of slots, the current and the next observation of every env
+        self.builder = ObservationBuilder(slots=2 * num_envs)
+        self.half = 0
+        self.started = [False] * num_envs
+        self.stepz = np.zeros(num_envs, dtype=np.int64)
+        self.waiting_time = np.zeros(num_envs, dtype=np.int64)
+
+    def _start(self, i):
+        args = ["-c", "cross3ltl.sumocfg", "-r", self.route_file, '--start']
+        if self.started[i]:
+            traci.switch(self.labels[i])
+            traci.load(args)
+        else:
+            traci.start([self.sumoBinary] + args, label=self.labels[i])
+            traci.switch(self.labels[i])
+            self.started[i] = True
+        traci.trafficlight.setPhase("0", 0)
+        traci.trafficlight.setPhaseDuration("0", 200)
+        self.stepz[i] = 0
+        self.waiting_time[i] = 0
+
+    def _observe(self, i):
+        # First step of a macro-step as in the main loop, then the observation
+        traci.simulationStep()
+        self.builder.build(slot=self.half * self.num_envs + i)
+
+    def _batch(self):
+        lo, hi = self.half * self.num_envs, (self.half + 1) * self.num_envs
+        return [self.builder.position[lo:hi], self.builder.velocity[lo:hi], self.builder.light[lo:hi]]
+
+    def reset(self):
+        for i in range(self.num_envs):
+            self._start(i)
+            self._observe(i)
+        return self._batch()
+
+    def step(self, actions):
+        # Returns the batched next states, rewards, dones and the finished
+        # episodes' waiting times (None for envs still running)
+        states = self._batch()
+        self.half = 1 - self.half
+        rewards = np.zeros(self.num_envs, dtype=np.float64)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        finished = [None] * self.num_envs
+        for i in range(self.num_envs):
+            traci.switch(self.labels[i])
+            current = 0 if states[2][i, 0, 0] == 1 else 1
+            for phase, duration, reward_edges in action_segments(int(actions[i]), current, self.tg, self.ty):
+                steps, waiting, r1, r2 = self.sumoInt.run_phase(phase, duration, None, reward_edges)
+                self.stepz[i] += steps
+                self.waiting_time[i] += waiting
+                if reward_edges is not None:
+                    rewards[i] = r1 - r2
+            self.builder.build(slot=self.half * self.num_envs + i)
+            if traci.simulation.getMinExpectedNumber() == 0 or self.stepz[i] >= self.max_steps:
+                dones[i] = True
+                finished[i] = int(self.waiting_time[i])
+        next_states = [s.copy() for s in self._batch()]
+        # Finished envs start over, their next observation is the new episode's first
+        for i in np.flatnonzero(dones):
+            self._start(i)
+        for i in range(self.num_envs):
+            traci.switch(self.labels[i])
+            self._observe(i)
+        return next_states, rewards, dones, finished
+
+    def close(self):
+        for i, label in enumerate(self.labels):
+            if self.started[i]:
+                traci.switch(label)
+                traci.close(wait=False)
+
+
+def run(agent, env, steps, batch_size=32, train=True):
+    # Lockstep loop, returns environment steps per second
+    states = env.reset()
+    start = time.time()
+    for step in range(steps):
+        actions = agent.act_batch(states)
+        next_states, rewards, dones, finished = env.step(actions)
+        for i in range(env.num_envs):
+            state = [s[i:i + 1].copy() for s in states]
+            agent.remember(state, actions[i], rewards[i], [s[i:i + 1] for s in next_states], dones[i])
+            if finished[i] is not None:
+                print(env.labels[i] + ' total waiting time - ' + str(finished[i]))
+        if train and len(agent.memory) > batch_size:
+            agent.replay(batch_size)
+        states = env._batch()
+    return steps * env.num_envs / (time.time() - start)
+
+
+if __name__ == '__main__':
+    from sumolib import checkBinary
+
+    optParser = optparse.OptionParser()
+    optParser.add_option("--envs", type="int", default=4)
+    optParser.add_option("--steps", type="int", default=500, help="lockstep macro-steps")
+    optParser.add_option("--no-train", action="store_true", default=False,
+                         help="only select actions, measures the environment and inference")
+    optParser.add_option("--benchmark", action="store_true", default=False,
+                         help="also run the same steps on K single-instance environments")
+    optParser.add_option("--weights", default="Models/reinf_traf_control.h5")
+    options, args = optParser.parse_args()
+
+    SumoIntersection().generate_routefile()
+    sumoBinary = checkBinary('sumo')
+    agent = DQNAgent()
+    try:
+        agent.load(options.weights)
+    except Exception:
+        print('No models found')
+
+    env = VectorSumoEnv(options.envs, sumoBinary)
+    rate = run(agent, env, options.steps, train=not options.no_train)
+    env.close()
+    print('vector env - %d envs, %.1f env steps/s' % (options.envs, rate))
+
+    if options.benchmark:
+        start = time.time()
+        for k in range(options.envs):
+            single = VectorSumoEnv(1, sumoBinary)
+            single.labels = ['single%d' % k]
+            run(agent, single, options.steps, train=not options.no_train)
+            single.close()
+        print('independent - %d runs, %.1f env steps/s' % (
+            options.envs, options.envs * options.steps / (time.time() - start)))